@@ -0,0 +1,74 @@
+# type: ignore
+"""Compare worker throughput with and without cpu pinning.
+
+Run with ``python benchmarks/affinity.py --help``. The numpy workload is
+used if numpy is installed, since its native thread pools are what
+oversubscribes the machine without pinning.
+"""
+import asyncio
+import time
+
+import click
+
+from cpias.affinity import CPULayout, get_available_cpus
+from cpias.executor import KIND_PROCESS, NamedExecutor
+
+
+def numpy_work(size):
+    """Multiply two random matrices."""
+    import numpy  # pylint: disable=import-outside-toplevel
+
+    matrix = numpy.random.random((size, size))
+    return float(matrix.dot(matrix).sum())
+
+
+def python_work(size):
+    """Do pure python work of about the same size."""
+    return sum(i * i for i in range(size * size * 4))
+
+
+async def run_jobs(executor, func, size, jobs):
+    """Run jobs in the executor and return the jobs per second."""
+    # Start the workers before timing.
+    await asyncio.gather(*(executor.submit(func, 1) for _ in range(jobs)))
+    start = time.perf_counter()
+    await asyncio.gather(*(executor.submit(func, size) for _ in range(jobs)))
+    return jobs / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option("--workers", default=None, type=int, help="Worker processes.")
+@click.option("--cores-per-worker", default=1, show_default=True, type=int)
+@click.option("--reserved-cores", default=1, show_default=True, type=int)
+@click.option("--jobs", default=64, show_default=True, type=int)
+@click.option("--size", default=500, show_default=True, type=int)
+def main(workers, cores_per_worker, reserved_cores, jobs, size):
+    """Compare worker throughput with and without cpu pinning."""
+    try:
+        import numpy  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+
+        func = numpy_work
+    except ImportError:
+        click.echo("numpy isn't installed, using a pure python workload")
+        func = python_work
+
+    layout = CPULayout(cores_per_worker=cores_per_worker, reserved_cores=reserved_cores)
+    workers = workers or layout.max_workers
+    click.echo(
+        f"cpus: {len(get_available_cpus())}, workers: {workers}, "
+        f"cores per worker: {cores_per_worker}, reserved cores: {reserved_cores}"
+    )
+
+    results = {}
+    for name, executor_layout in (("unpinned", None), ("pinned", layout)):
+        executor = NamedExecutor(name, KIND_PROCESS, workers, executor_layout)
+        results[name] = asyncio.run(run_jobs(executor, func, size, jobs))
+        executor.shutdown()
+        click.echo(f"{name:<10} {results[name]:10.2f} jobs/s")
+
+    diff = (results["pinned"] - results["unpinned"]) / results["unpinned"]
+    click.echo(f"{'diff':<10} {diff:+10.1%}")
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
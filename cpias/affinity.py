@@ -0,0 +1,154 @@
+"""Provide cpu affinity and native thread pool limits for worker processes."""
+import os
+from itertools import islice
+from typing import Any, List, Optional, Sequence, Set
+
+from .const import LOGGER
+
+# Environment variables read by common native thread pools on start.
+THREAD_LIMIT_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+
+def get_available_cpus() -> List[int]:
+    """Return the cpus that this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class CPULayout:
+    """Represent how cpus are split between the event loop and workers.
+
+    The first reserved_cores cpus are left to the event loop and the thread
+    pools of the server. The other cpus are split into disjoint sets of
+    cores_per_worker cpus. The last persistent_workers sets are kept for
+    persistent processes and the other sets are used by process pools.
+    Workers get the least used set, and share sets only when there are more
+    workers than sets.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        cores_per_worker: int = 1,
+        reserved_cores: int = 1,
+        threads_per_worker: Optional[int] = None,
+        cpus: Optional[Sequence[int]] = None,
+        persistent_workers: int = 0,
+    ) -> None:
+        """Set up the layout.
+
+        Native thread pools of each worker are limited to
+        threads_per_worker threads, which defaults to cores_per_worker.
+        """
+        if cores_per_worker < 1:
+            raise ValueError("cores_per_worker must be at least 1")
+        if reserved_cores < 0:
+            raise ValueError("reserved_cores can't be negative")
+        if persistent_workers < 0:
+            raise ValueError("persistent_workers can't be negative")
+        if cpus is None:
+            cpus = get_available_cpus()
+        self.cores_per_worker = cores_per_worker
+        self.reserved_cores = reserved_cores
+        self.threads_per_worker = threads_per_worker or cores_per_worker
+        self.reserved_cpus = list(cpus[:reserved_cores])
+        worker_cpus = list(cpus[reserved_cores:])
+        if len(worker_cpus) < cores_per_worker:
+            LOGGER.warning(
+                "Too few cpus to reserve %s cores, sharing all cpus with workers",
+                reserved_cores,
+            )
+            worker_cpus = list(cpus)
+        cpu_iter = iter(worker_cpus)
+        self.worker_sets = [
+            set(islice(cpu_iter, cores_per_worker))
+            for _ in range(max(len(worker_cpus) // cores_per_worker, 1))
+        ]
+        set_count = len(self.worker_sets)
+        if persistent_workers >= set_count:
+            LOGGER.warning(
+                "Too few cpu sets to keep %s for persistent processes, "
+                "sharing all sets with process pools",
+                persistent_workers,
+            )
+            persistent_workers = 0
+        split = set_count - persistent_workers
+        self._pool_sets = list(range(split))
+        self._persistent_sets = list(range(split, set_count)) or self._pool_sets
+        self._usage = [0] * set_count
+
+    @property
+    def max_workers(self) -> int:
+        """Return the number of pool workers that get disjoint cpu sets."""
+        return len(self._pool_sets)
+
+    @property
+    def free_pool_sets(self) -> int:
+        """Return the number of cpu sets of process pools that are unused."""
+        return sum(1 for index in self._pool_sets if not self._usage[index])
+
+    def allocate(self, persistent: bool = False) -> Set[int]:
+        """Return the cpu set of the next worker.
+
+        Persistent processes get sets that are kept for them if any. Log a
+        warning if the worker has to share its set with another worker.
+        """
+        indexes = self._persistent_sets if persistent else self._pool_sets
+        index = min(indexes, key=self._usage.__getitem__)
+        cpus = self.worker_sets[index]
+        if self._usage[index]:
+            LOGGER.warning(
+                "All cpu sets are taken, sharing cpus %s with another worker",
+                sorted(cpus),
+            )
+        self._usage[index] += 1
+        return cpus
+
+
+def init_worker(cpus: Optional[Set[int]], threads: Optional[int]) -> None:
+    """Pin the current process to cpus and limit its native thread pools.
+
+    The environment variables only affect libraries that are imported after
+    this call. Thread pools that are already loaded are limited with
+    threadpoolctl if it's installed, otherwise a warning is logged.
+    """
+    if cpus and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as exc:
+            LOGGER.warning("Failed to set cpu affinity %s: %s", sorted(cpus), exc)
+    if threads is None:
+        return
+    for env_var in THREAD_LIMIT_ENV_VARS:
+        os.environ[env_var] = str(threads)
+    try:
+        from threadpoolctl import (  # pylint: disable=import-outside-toplevel
+            threadpool_limits,
+        )
+    except ImportError:
+        LOGGER.warning(
+            "threadpoolctl isn't installed, native thread pools that are "
+            "already loaded aren't limited to %s threads",
+            threads,
+        )
+        return
+    threadpool_limits(limits=threads)
+
+
+def init_pool_worker(cpu_sets: Any, threads: Optional[int]) -> None:
+    """Initialize a process pool worker with the next free cpu set.
+
+    The cpu sets are passed in a multiprocessing simple queue that holds one
+    set per worker, so that each worker of the pool gets its own set.
+    """
+    cpus = None if cpu_sets.empty() else cpu_sets.get()
+    init_worker(cpus, threads)
@@ -0,0 +1,254 @@
+"""Provide traffic capture and replay for performance regression testing.
+
+A capture file is append-only and holds one compact json record per line,
+with the keys ``t`` (receive time in seconds since the epoch), ``r`` (id of
+the server run), ``c`` (connection id within the run), ``m`` (the message
+blocks) and ``x`` (set if the payload was truncated).
+"""
+import asyncio
+import json
+import os
+import random
+import time
+from itertools import count
+from pathlib import Path
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from .client import open_connection
+from .const import LOGGER
+from .message import CANCEL_COMMAND, REQUEST_ID_KEY, Message, MessageBlock
+
+TRUNCATED_FLAG = "x"
+
+
+class CaptureWriter:
+    """Record incoming messages to a capture file.
+
+    Sampling is done per connection, so that the message sequence of a
+    sampled connection is captured in full.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        sample_rate: float = 1.0,
+        max_payload: Optional[int] = None,
+    ) -> None:
+        """Set up capture writer.
+
+        String values in the message data longer than max_payload
+        characters are truncated.
+        """
+        if max_payload is not None and max_payload < 0:
+            raise ValueError("max_payload can't be negative")
+        self.path = Path(path)
+        self.sample_rate = sample_rate
+        self.max_payload = max_payload
+        # Connection ids restart for each run, so tell runs apart.
+        self.run_id = f"{os.getpid()}-{time.time_ns()}"
+        self._conn_ids = count()
+        self._file: Optional[IO[str]] = None
+
+    def new_connection(self) -> Optional[int]:
+        """Return a connection id, or None if the connection isn't sampled."""
+        conn_id = next(self._conn_ids)
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+        return conn_id
+
+    def record(self, conn_id: int, message: Message) -> None:
+        """Append a message to the capture file.
+
+        The file is line buffered, so that each record is on disk as soon as
+        it's written, even if the server is killed.
+        """
+        if self._file is None:
+            self._file = self.path.open("a", buffering=1, encoding="utf-8")
+        data, truncated = truncate(message.data, self.max_payload)
+        record: Dict[str, Any] = {
+            "t": round(time.time(), 6),
+            "r": self.run_id,
+            "c": conn_id,
+            "m": {
+                MessageBlock.client.value: message.client,
+                MessageBlock.command.value: message.command,
+                MessageBlock.data.value: data,
+            },
+        }
+        if message.request_id is not None:
+            record["m"][REQUEST_ID_KEY] = message.request_id
+        if truncated:
+            record[TRUNCATED_FLAG] = 1
+        self._file.write(f"{json.dumps(record, separators=(',', ':'))}\n")
+
+    def close(self) -> None:
+        """Flush and close the capture file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def truncate(data: Any, max_payload: Optional[int]) -> Tuple[Any, bool]:
+    """Return data with long strings truncated and if anything was truncated."""
+    if max_payload is None:
+        return data, False
+    if isinstance(data, str):
+        if len(data) > max_payload:
+            return data[:max_payload], True
+        return data, False
+    if isinstance(data, dict):
+        items = {key: truncate(value, max_payload) for key, value in data.items()}
+        return (
+            {key: value for key, (value, _) in items.items()},
+            any(flag for _, flag in items.values()),
+        )
+    if isinstance(data, list):
+        values = [truncate(value, max_payload) for value in data]
+        return [value for value, _ in values], any(flag for _, flag in values)
+    return data, False
+
+
+def read_capture(path: Union[str, Path]) -> Iterator[Tuple[float, str, int, str]]:
+    """Yield receive time, run id, connection id and encoded message per record."""
+    with Path(path).open(encoding="utf-8") as capture_file:
+        for line in capture_file:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                encoded = f"{json.dumps(record['m'])}\n"
+                yield record["t"], record.get("r", ""), record["c"], encoded
+            except (ValueError, KeyError):
+                LOGGER.error("Skipping invalid capture record: %s", line.strip())
+
+
+class ReplayStats:
+    """Represent the result of a replay."""
+
+    def __init__(self, address: str) -> None:
+        """Set up replay stats."""
+        self.address = address
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.duration = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Return the replies per second."""
+        if not self.duration:
+            return 0.0
+        return len(self.latencies) / self.duration
+
+    def percentile(self, percent: float) -> float:
+        """Return a latency percentile in seconds."""
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * percent / 100))
+        return latencies[index]
+
+    def summary(self) -> Dict[str, float]:
+        """Return a summary of the replay."""
+        mean = sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+        return {
+            "replies": len(self.latencies),
+            "errors": self.errors,
+            "duration_s": self.duration,
+            "throughput_per_s": self.throughput,
+            "latency_mean_ms": mean * 1000,
+            "latency_p50_ms": self.percentile(50) * 1000,
+            "latency_p95_ms": self.percentile(95) * 1000,
+            "latency_p99_ms": self.percentile(99) * 1000,
+            "latency_max_ms": max(self.latencies, default=0.0) * 1000,
+        }
+
+
+async def replay(
+    path: Union[str, Path], address: str, speed: float = 1.0, timeout: float = 30.0,
+) -> ReplayStats:
+    """Replay a capture file against the server at address.
+
+    Messages are sent at the original timing divided by speed, or as fast
+    as possible if speed is 0. Server runs in the same capture file are
+    replayed one after the other, without the time between the runs. Each
+    captured connection is replayed over its own connection, waiting for
+    each reply before sending the next message, except for cancel messages
+    that get no reply. A reply that doesn't arrive within timeout seconds
+    counts as an error and ends the replay of that connection.
+    """
+    records = list(read_capture(path))
+    # Map each run to its first receive time and its start in the replay.
+    run_times: Dict[str, Tuple[float, float]] = {}
+    replay_end = 0.0
+    for recv_time, run_id, _, _ in records:
+        if run_id not in run_times:
+            run_times[run_id] = (recv_time, replay_end)
+        first_time, run_start = run_times[run_id]
+        replay_end = max(replay_end, run_start + recv_time - first_time)
+
+    connections: Dict[Tuple[str, int], List[Tuple[float, str]]] = {}
+    for recv_time, run_id, conn_id, line in records:
+        first_time, run_start = run_times[run_id]
+        offset = run_start + recv_time - first_time
+        connections.setdefault((run_id, conn_id), []).append((offset, line))
+
+    stats = ReplayStats(address)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    async def replay_connection(messages: List[Tuple[float, str]]) -> None:
+        """Replay the messages of one connection."""
+        try:
+            reader, writer = await open_connection(address)
+            await asyncio.wait_for(reader.readline(), timeout)
+        except (OSError, asyncio.TimeoutError) as exc:
+            LOGGER.error("Failed to connect to %s: %s", address, exc)
+            stats.errors += len(messages)
+            return
+
+        for index, (offset, line) in enumerate(messages):
+            if speed:
+                delay = start + offset / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            sent = loop.time()
+            msg = Message.decode(line)
+            try:
+                writer.write(line.encode())
+                await writer.drain()
+                if msg is not None and msg.command == CANCEL_COMMAND:
+                    continue
+                reply = await asyncio.wait_for(reader.readline(), timeout)
+            except (OSError, asyncio.TimeoutError):
+                reply = b""
+            if not reply:
+                stats.errors += len(messages) - index
+                break
+            stats.latencies.append(loop.time() - sent)
+
+        writer.close()
+
+    await asyncio.gather(
+        *(replay_connection(messages) for messages in connections.values())
+    )
+    stats.duration = loop.time() - start
+    return stats
+
+
+def format_comparison(base: ReplayStats, other: Optional[ReplayStats] = None) -> str:
+    """Return a table of replay stats, with differences if two are given."""
+    base_summary = base.summary()
+    if other is None:
+        lines = [f"{'metric':<18} {base.address:>20}"]
+        lines.extend(
+            f"{name:<18} {value:>20.3f}" for name, value in base_summary.items()
+        )
+        return "\n".join(lines)
+
+    other_summary = other.summary()
+    lines = [f"{'metric':<18} {base.address:>20} {other.address:>20} {'diff':>9}"]
+    for name, value in base_summary.items():
+        other_value = other_summary[name]
+        diff = f"{(other_value - value) / value:+.1%}" if value else "-"
+        lines.append(f"{name:<18} {value:>20.3f} {other_value:>20.3f} {diff:>9}")
+    return "\n".join(lines)
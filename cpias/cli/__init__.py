@@ -6,6 +6,8 @@ import click
 
 from cpias import __version__
 from cpias.cli.client import run_client
+from cpias.cli.gateway import start_gateway
+from cpias.cli.replay import run_replay
 from cpias.cli.server import start_server
 
 SETTINGS = dict(help_option_names=["-h", "--help"])
@@ -29,3 +31,5 @@ def cli(ctx, debug):
 
 cli.add_command(start_server)
 cli.add_command(run_client)
+cli.add_command(start_gateway)
+cli.add_command(run_replay, name="replay")
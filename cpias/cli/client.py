@@ -1,11 +1,12 @@
 # type: ignore
 """Provide a CLI to start a client."""
 import asyncio
+import os
 
 import click
 
-from cpias.cli.common import common_tcp_options
-from cpias.client import tcp_client
+from cpias.cli.common import common_tcp_options, common_unix_options
+from cpias.client import tcp_client, unix_client
 
 DEFAULT_MESSAGE = '{"cli": "client-1", "cmd": "hello", "dta": {"planet": "world"}}\n'
 
@@ -13,10 +14,29 @@ DEFAULT_MESSAGE = '{"cli": "client-1", "cmd": "hello", "dta": {"planet": "world"
 @click.command(options_metavar="<options>")
 @click.option("--message", default=DEFAULT_MESSAGE, help="Message to send to server.")
 @common_tcp_options
+@common_unix_options
+@click.option(
+    "--fd-file",
+    "fd_files",
+    multiple=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="File to pass as a file descriptor. Requires --unix-socket.",
+)
 @click.pass_context
-def run_client(ctx, message, host, port):
-    """Run an async tcp client to connect to the server."""
+def run_client(ctx, message, host, port, unix_socket, fd_files):
+    """Run an async tcp or unix socket client to connect to the server."""
     debug = ctx.obj["debug"]
-    asyncio.run(
-        tcp_client(message, host=host, port=port), debug=debug,
-    )
+    if unix_socket is None:
+        if fd_files:
+            raise click.UsageError("--fd-file requires --unix-socket")
+        asyncio.run(
+            tcp_client(message, host=host, port=port), debug=debug,
+        )
+        return
+
+    fds = [os.open(fd_file, os.O_RDONLY) for fd_file in fd_files]
+    try:
+        asyncio.run(unix_client(message, unix_socket, fds=fds), debug=debug)
+    finally:
+        for fd in fds:
+            os.close(fd)
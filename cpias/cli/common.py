@@ -21,3 +21,15 @@ def common_tcp_options(func):
         help="TCP address of the server.",
     )(func)
     return func
+
+
+def common_unix_options(func):
+    """Supply common unix domain socket connection options."""
+    func = click.option(
+        "-u",
+        "--unix-socket",
+        default=None,
+        type=click.Path(dir_okay=False),
+        help="Path of the unix domain socket.",
+    )(func)
+    return func
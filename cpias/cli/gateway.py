@@ -0,0 +1,109 @@
+# type: ignore
+"""Provide a CLI to start a gateway server."""
+import asyncio
+
+import click
+
+from cpias.cli.common import common_tcp_options, common_unix_options
+from cpias.gateway import (
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_MAX_CONNECTIONS,
+    DEFAULT_REQUEST_TIMEOUT,
+    ROUTING_LEAST_OUTSTANDING,
+    ROUTINGS,
+    CPIAGateway,
+)
+
+
+@click.command(options_metavar="<options>")
+@common_tcp_options
+@common_unix_options
+@click.option(
+    "-b",
+    "--backend",
+    "backends",
+    multiple=True,
+    required=True,
+    help="Backend server address as host:port or unix:/path/to/socket.",
+)
+@click.option(
+    "--routing",
+    default=ROUTING_LEAST_OUTSTANDING,
+    show_default=True,
+    type=click.Choice(ROUTINGS),
+    help="How to choose the backend for a message.",
+)
+@click.option(
+    "--hash-key",
+    default=None,
+    help="Message data item to hash on instead of the client id.",
+)
+@click.option(
+    "--retries",
+    default=2,
+    show_default=True,
+    type=int,
+    help="Number of other backends to try when a request fails.",
+)
+@click.option(
+    "--health-interval",
+    default=5.0,
+    show_default=True,
+    type=float,
+    help="Seconds between backend health checks.",
+)
+@click.option(
+    "--request-timeout",
+    default=DEFAULT_REQUEST_TIMEOUT,
+    show_default=True,
+    type=click.FloatRange(min=0.0),
+    help="Seconds to wait for a backend reply. Use 0 to wait forever.",
+)
+@click.option(
+    "--max-connections",
+    default=DEFAULT_MAX_CONNECTIONS,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Max concurrent connections per backend.",
+)
+@click.option(
+    "--connect-timeout",
+    default=DEFAULT_CONNECT_TIMEOUT,
+    show_default=True,
+    type=float,
+    help="Seconds to wait for a backend to accept a connection.",
+)
+@click.pass_context
+def start_gateway(
+    ctx,
+    host,
+    port,
+    unix_socket,
+    backends,
+    routing,
+    hash_key,
+    retries,
+    health_interval,
+    request_timeout,
+    max_connections,
+    connect_timeout,
+):
+    """Start a gateway server that forwards messages to backend servers."""
+    debug = ctx.obj["debug"]
+    server = CPIAGateway(
+        backends,
+        routing=routing,
+        hash_key=hash_key,
+        retries=retries,
+        health_interval=health_interval,
+        request_timeout=request_timeout or None,
+        max_connections=max_connections,
+        connect_timeout=connect_timeout,
+        host=host,
+        port=port,
+        unix_path=unix_socket,
+    )
+    try:
+        asyncio.run(server.start(), debug=debug)
+    except KeyboardInterrupt:
+        asyncio.run(server.stop(), debug=debug)
@@ -0,0 +1,48 @@
+# type: ignore
+"""Provide a CLI to replay captured traffic."""
+import asyncio
+
+import click
+
+from cpias.capture import format_comparison, replay
+
+
+@click.command(options_metavar="<options>")
+@click.argument("capture", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "-t",
+    "--target",
+    "targets",
+    multiple=True,
+    default=["127.0.0.1:8555"],
+    show_default=True,
+    help=(
+        "Server address as host:port or unix:/path/to/socket. "
+        "Give two targets to compare two servers."
+    ),
+)
+@click.option(
+    "--speed",
+    default=1.0,
+    show_default=True,
+    type=click.FloatRange(min=0.0),
+    help="Replay speed relative to the original timing. Use 0 for max speed.",
+)
+@click.option(
+    "--timeout",
+    default=30.0,
+    show_default=True,
+    type=float,
+    help="Seconds to wait for each reply.",
+)
+@click.pass_context
+def run_replay(ctx, capture, targets, speed, timeout):
+    """Replay a capture file against one or two servers and report stats."""
+    debug = ctx.obj["debug"]
+    if len(targets) > 2:
+        raise click.UsageError("Give at most two targets")
+    results = [
+        asyncio.run(replay(capture, target, speed=speed, timeout=timeout), debug=debug)
+        for target in targets
+    ]
+    click.echo(format_comparison(*results))
@@ -4,17 +4,117 @@ import asyncio
 
 import click
 
-from cpias.cli.common import common_tcp_options
+from cpias.affinity import CPULayout
+from cpias.capture import CaptureWriter
+from cpias.cli.common import common_tcp_options, common_unix_options
 from cpias.server import CPIAServer
 
 
 @click.command(options_metavar="<options>")
 @common_tcp_options
+@common_unix_options
+@click.option(
+    "--tcp/--no-tcp",
+    default=True,
+    show_default=True,
+    help="Listen on tcp. Use --no-tcp to only listen on the unix socket.",
+)
+@click.option(
+    "--capture",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Append incoming messages to this capture file.",
+)
+@click.option(
+    "--capture-sample-rate",
+    default=1.0,
+    show_default=True,
+    type=click.FloatRange(0.0, 1.0),
+    help="Fraction of connections to capture.",
+)
+@click.option(
+    "--capture-max-payload",
+    default=None,
+    type=click.IntRange(min=0),
+    help="Truncate captured data strings longer than this many characters.",
+)
+@click.option(
+    "--cancel-on-eof/--no-cancel-on-eof",
+    default=False,
+    show_default=True,
+    help="Cancel the running command when the client closes its side of the "
+    "connection. Only use this if clients don't half close connections.",
+)
+@click.option(
+    "--cores-per-worker",
+    default=None,
+    type=click.IntRange(min=1),
+    help="Pin each worker process to its own set of this many cores.",
+)
+@click.option(
+    "--reserved-cores",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help="Cores kept free of worker processes, for the event loop.",
+)
+@click.option(
+    "--persistent-workers",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help="Cpu sets kept for persistent processes instead of process pools.",
+)
+@click.option(
+    "--threads-per-worker",
+    default=None,
+    type=click.IntRange(min=1),
+    help="Limit native thread pools of worker processes. [default: cores per worker]",
+)
 @click.pass_context
-def start_server(ctx, host, port):
-    """Start an async tcp server."""
+def start_server(
+    ctx,
+    host,
+    port,
+    unix_socket,
+    tcp,
+    capture,
+    capture_sample_rate,
+    capture_max_payload,
+    cancel_on_eof,
+    cores_per_worker,
+    reserved_cores,
+    persistent_workers,
+    threads_per_worker,
+):
+    """Start an async tcp and/or unix socket server."""
     debug = ctx.obj["debug"]
-    server = CPIAServer(host=host, port=port)
+    if not tcp and unix_socket is None:
+        raise click.UsageError("--no-tcp requires --unix-socket")
+    capture_writer = None
+    if capture is not None:
+        capture_writer = CaptureWriter(
+            capture, sample_rate=capture_sample_rate, max_payload=capture_max_payload
+        )
+    if threads_per_worker is not None and cores_per_worker is None:
+        raise click.UsageError("--threads-per-worker requires --cores-per-worker")
+    cpu_layout = None
+    if cores_per_worker is not None:
+        cpu_layout = CPULayout(
+            cores_per_worker=cores_per_worker,
+            reserved_cores=reserved_cores,
+            threads_per_worker=threads_per_worker,
+            persistent_workers=persistent_workers,
+        )
+    server = CPIAServer(
+        host=host,
+        port=port,
+        unix_path=unix_socket,
+        tcp=tcp,
+        capture=capture_writer,
+        cpu_layout=cpu_layout,
+        cancel_on_eof=cancel_on_eof,
+    )
     try:
         asyncio.run(server.start(), debug=debug)
     except KeyboardInterrupt:
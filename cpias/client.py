@@ -1,16 +1,41 @@
 """Provide a test client for the CPIAServer."""
 import asyncio
+from typing import Sequence, Tuple, Union
 
 from cpias.const import LOGGER
+from cpias.unix import UnixReader, UnixWriter, close_fds, open_unix_connection
+
+UNIX_PREFIX = "unix:"
+
+
+async def open_connection(
+    address: str,
+) -> Tuple[
+    Union[asyncio.StreamReader, UnixReader], Union[asyncio.StreamWriter, UnixWriter]
+]:
+    """Open a connection to a server address and return reader and writer.
+
+    The address is either ``host:port`` or ``unix:/path/to/socket``.
+    The welcome message is not consumed.
+    """
+    if address.startswith(UNIX_PREFIX):
+        return await open_unix_connection(address.replace(UNIX_PREFIX, "", 1))
+    host, _, port = address.rpartition(":")
+    return await asyncio.open_connection(host, int(port))
 
 
 async def tcp_client(message: str, host: str = "127.0.0.1", port: int = 8555) -> None:
-    """Connect to server and send message."""
+    """Connect to server and send message.
+
+    A line break is added to the message if it's missing.
+    """
     reader, writer = await asyncio.open_connection(host, port)
     data = await reader.readline()
     version_msg = data.decode()
     LOGGER.debug("Version message: %s", version_msg.strip())
 
+    if not message.endswith("\n"):
+        message = f"{message}\n"
     LOGGER.info("Send: %r", message)
     writer.write(message.encode())
     await writer.drain()
@@ -23,6 +48,35 @@ async def tcp_client(message: str, host: str = "127.0.0.1", port: int = 8555) ->
     await writer.wait_closed()
 
 
+async def unix_client(message: str, path: str, fds: Sequence[int] = ()) -> None:
+    """Connect to server over a Unix domain socket and send message.
+
+    Pass the file descriptors in fds together with the message. A line
+    break is added to the message if it's missing.
+    """
+    reader, writer = await open_unix_connection(path)
+    data = await reader.readline()
+    version_msg = data.decode()
+    LOGGER.debug("Version message: %s", version_msg.strip())
+
+    if not message.endswith("\n"):
+        message = f"{message}\n"
+    LOGGER.info("Send: %r with file descriptors %s", message, list(fds))
+    writer.write(message.encode(), fds)
+    await writer.drain()
+
+    data = await reader.readline()
+    LOGGER.info("Received: %r", data.decode())
+    if reader.last_fds:
+        LOGGER.info("Received file descriptors: %s", reader.last_fds)
+        close_fds(reader.last_fds)
+
+    LOGGER.debug("Closing the connection")
+    reader.close()
+    writer.close()
+    await writer.wait_closed()
+
+
 if __name__ == "__main__":
     asyncio.run(
         tcp_client('{"cli": "client-1", "cmd": "hello", "dta": {"planet": "world"}}\n'),
@@ -38,7 +38,12 @@ def validate(schema: dict) -> Callable:
                 LOGGER.error(
                     "Received invalid data for command %s: %s", message.command, err
                 )
-                return Message(client=message.client, command="invalid", data=data)
+                return Message(
+                    client=message.client,
+                    command="invalid",
+                    data=data,
+                    request_id=message.request_id,
+                )
 
             return await func(server, message, **data)
 
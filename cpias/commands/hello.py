@@ -1,4 +1,5 @@
 """Provide the hello command."""
+import os
 from typing import TYPE_CHECKING, Callable, Optional, Tuple
 
 from cpias.commands import validate
@@ -18,6 +19,7 @@ def register_command(server: "CPIAServer") -> None:
     server.register_command("hello_slow", hello_slow)
     server.register_command("hello_persistent", hello_persistent)
     server.register_command("hello_process", hello_process)
+    server.register_command("hello_fds", hello_fds)
 
 
 @validate({"planet": str})
@@ -94,10 +96,10 @@ async def hello_process(
 
     recv, send = server.store["hello_process"]
 
-    await send(planet)
+    job_id = await send(planet)
 
     try:
-        old_planet, new_planet = await recv()
+        old_planet, new_planet = await recv(job_id)
     except ReceiveError:
         return message
 
@@ -112,6 +114,28 @@ async def hello_process(
     return reply
 
 
+@validate({"planet": str})
+async def hello_fds(
+    server: "CPIAServer", message: Message, planet: Optional[str] = None
+) -> Message:
+    """Run the file descriptor hello command.
+
+    This command reports the size of the files passed as file descriptors
+    over a unix socket, without copying their content.
+    """
+    if planet is None:
+        planet = "Jupiter"
+
+    sizes = [os.fstat(fd).st_size for fd in message.fds]
+
+    LOGGER.info("Hello %s! Received files of sizes %s", planet, sizes)
+
+    reply = message.copy()
+    reply.data["sizes"] = sizes
+
+    return reply
+
+
 def do_cpu_work() -> int:
     """Do work that should run in the process pool."""
     return sum(i * i for i in range(10 ** 7))
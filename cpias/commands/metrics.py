@@ -0,0 +1,22 @@
+"""Provide the metrics command."""
+from typing import TYPE_CHECKING, Any
+
+from cpias.message import Message
+
+if TYPE_CHECKING:
+    from cpias.server import CPIAServer
+
+# pylint: disable=unused-argument
+
+
+def register_command(server: "CPIAServer") -> None:
+    """Register the metrics command."""
+    server.register_command("metrics", metrics)
+
+
+async def metrics(server: "CPIAServer", message: Message, **data: Any) -> Message:
+    """Reply with the server metrics."""
+    reply = message.copy()
+    reply.data.update(server.metrics())
+
+    return reply
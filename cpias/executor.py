@@ -0,0 +1,138 @@
+"""Provide named executors for running blocking and cpu bound jobs."""
+import asyncio
+import concurrent.futures
+import multiprocessing
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+from .affinity import CPULayout, init_pool_worker
+
+DEFAULT_EXECUTOR = "default"
+PROCESS_EXECUTOR = "process"
+INTERNAL_EXECUTOR = "internal"
+INTERNAL_EXECUTOR_SIZE = 4
+KIND_THREAD = "thread"
+KIND_PROCESS = "process"
+KINDS = (KIND_THREAD, KIND_PROCESS)
+
+# The executor of the command that is currently running, if any.
+current_executor: "ContextVar[Optional[str]]" = ContextVar(
+    "current_executor", default=None
+)
+
+
+class NamedExecutor:
+    """Represent a thread or process pool with a name and usage stats.
+
+    The pool is created when the first job is submitted.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        kind: str = KIND_THREAD,
+        max_workers: Optional[int] = None,
+        layout: Optional[CPULayout] = None,
+    ) -> None:
+        """Set up the executor.
+
+        The workers of a process pool are pinned to cpus from layout if set.
+        """
+        if kind not in KINDS:
+            raise ValueError(f"Unknown executor kind {kind}, use one of {KINDS}")
+        self.name = name
+        self.kind = kind
+        self.max_workers = max_workers
+        self.layout = layout
+        self.pending = 0
+        self.peak_pending = 0
+        self.submitted = 0
+        self.cancelled = 0
+        self.abandoned = 0
+        self._executor: Optional[concurrent.futures.Executor] = None
+
+    @property
+    def executor(self) -> concurrent.futures.Executor:
+        """Return the pool, creating it if needed."""
+        if self._executor is None:
+            if self.kind == KIND_PROCESS and self.layout is not None:
+                self._executor = self._create_pinned_process_pool(self.layout)
+            elif self.kind == KIND_PROCESS:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self.max_workers
+                )
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix=f"cpias-{self.name}"
+                )
+            # Read back the size that the pool picked as default.
+            self.max_workers = self._executor._max_workers  # type: ignore
+        return self._executor
+
+    def _create_pinned_process_pool(
+        self, layout: CPULayout
+    ) -> concurrent.futures.ProcessPoolExecutor:
+        """Return a process pool with each worker pinned to its own cpu set.
+
+        The pool defaults to one worker per unused cpu set of the layout.
+        """
+        if self.max_workers is None:
+            self.max_workers = max(layout.free_pool_sets, 1)
+        cpu_sets: Any = multiprocessing.SimpleQueue()
+        for _ in range(self.max_workers):
+            cpu_sets.put(layout.allocate())
+        return concurrent.futures.ProcessPoolExecutor(
+            self.max_workers,
+            initializer=init_pool_worker,
+            initargs=(cpu_sets, layout.threads_per_worker),
+        )
+
+    def submit(self, func: Callable, *args: Any) -> asyncio.Future:
+        """Run a function in the pool and return an asyncio future.
+
+        Cancelling the asyncio future cancels the job if it hasn't started.
+        """
+        concurrent_future = self.executor.submit(func, *args)
+        future = asyncio.wrap_future(concurrent_future)
+        self.submitted += 1
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+
+        def job_done(future: asyncio.Future) -> None:
+            """Update stats when a job is done."""
+            self.pending -= 1
+            if not future.cancelled():
+                return
+            if concurrent_future.cancelled():
+                self.cancelled += 1
+            else:
+                # The job had already started and its result is discarded.
+                self.abandoned += 1
+
+        future.add_done_callback(job_done)
+        return future
+
+    def stats(self) -> Dict[str, Any]:
+        """Return usage stats.
+
+        Saturation is the number of pending jobs divided by the pool size.
+        A saturation above one means that jobs are queued.
+        """
+        max_workers = self.max_workers or 0
+        return {
+            "kind": self.kind,
+            "max_workers": self.max_workers,
+            "active": min(self.pending, max_workers),
+            "queued": max(self.pending - max_workers, 0),
+            "peak_pending": self.peak_pending,
+            "submitted": self.submitted,
+            "cancelled": self.cancelled,
+            "abandoned": self.abandoned,
+            "saturation": self.pending / max_workers if max_workers else 0.0,
+        }
+
+    def shutdown(self) -> None:
+        """Shut down the pool without waiting for running jobs."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,356 @@
+"""Provide a gateway server that distributes messages across cpias servers."""
+import asyncio
+import hashlib
+from bisect import bisect
+from typing import Any, Callable, List, Optional, Sequence, Set, Tuple, Union
+
+from .client import open_connection
+from .const import LOGGER
+from .exceptions import CPIASError
+from .message import Message
+from .server import CPIAServer
+from .unix import UnixReader, UnixWriter
+
+ROUTING_LEAST_OUTSTANDING = "least-outstanding"
+ROUTING_HASH = "hash"
+ROUTINGS = (ROUTING_LEAST_OUTSTANDING, ROUTING_HASH)
+UNAVAILABLE_COMMAND = "unavailable"
+VIRTUAL_NODES = 100
+# Backends don't reply to unknown commands, so a request must time out.
+DEFAULT_REQUEST_TIMEOUT = 60.0
+DEFAULT_MAX_CONNECTIONS = 10
+DEFAULT_CONNECT_TIMEOUT = 5.0
+
+Reader = Union[asyncio.StreamReader, UnixReader]
+Writer = Union[asyncio.StreamWriter, UnixWriter]
+
+
+class BackendError(CPIASError):
+    """Error raised when a request to a backend failed."""
+
+
+class Backend:
+    """Represent a backend cpias server with a connection pool.
+
+    The address is either ``host:port`` or ``unix:/path/to/socket``.
+    """
+
+    def __init__(
+        self,
+        address: str,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+    ) -> None:
+        """Set up the backend."""
+        self.address = address
+        self.healthy = True
+        self.outstanding = 0
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self._idle: List[Tuple[Reader, Writer]] = []
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def __repr__(self) -> str:
+        """Return the representation."""
+        return f"{type(self).__name__}(address={self.address})"
+
+    async def _connect(self) -> Tuple[Reader, Writer]:
+        """Open a connection and consume the welcome message."""
+        reader, writer = await open_connection(self.address)
+        version_msg = await reader.readline()
+        if not version_msg:
+            close_connection(writer)
+            raise ConnectionError(f"Backend {self.address} closed the connection")
+        return reader, writer
+
+    async def _connect_with_timeout(self) -> Tuple[Reader, Writer]:
+        """Open a connection, and fail with a connection error on timeout."""
+        try:
+            return await asyncio.wait_for(self._connect(), self.connect_timeout)
+        except asyncio.TimeoutError as exc:
+            raise ConnectionError(
+                f"Timed out connecting to backend {self.address}"
+            ) from exc
+
+    async def _send(
+        self, reader: Reader, writer: Writer, data: bytes, timeout: Optional[float]
+    ) -> bytes:
+        """Send data over a connection and return the reply line."""
+        try:
+            writer.write(data)
+            await writer.drain()
+            reply = await asyncio.wait_for(reader.readline(), timeout)
+        except BaseException:
+            close_connection(writer)
+            raise
+        if not reply:
+            close_connection(writer)
+            raise ConnectionError(f"Backend {self.address} closed the connection")
+        self._idle.append((reader, writer))
+        return reply
+
+    async def request(self, data: bytes, timeout: Optional[float] = None) -> bytes:
+        """Send data to the backend and return the reply line.
+
+        If a pooled connection fails, all idle connections are dropped, since
+        they are likely stale too, eg after a backend restart, and the request
+        is retried once on a new connection.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        self.outstanding += 1
+        try:
+            async with self._semaphore:
+                if self._idle:
+                    reader, writer = self._idle.pop()
+                    try:
+                        return await self._send(reader, writer, data, timeout)
+                    except asyncio.TimeoutError:
+                        # This is a subclass of OSError since Python 3.11.
+                        raise
+                    except OSError as exc:
+                        LOGGER.debug(
+                            "Pooled connection to %s failed: %s", self.address, exc
+                        )
+                        self.close()
+                reader, writer = await self._connect_with_timeout()
+                return await self._send(reader, writer, data, timeout)
+        finally:
+            self.outstanding -= 1
+
+    async def check_health(self) -> bool:
+        """Check that the backend accepts connections and update health."""
+        try:
+            _, writer = await self._connect_with_timeout()
+        except OSError as exc:
+            if self.healthy:
+                LOGGER.warning("Backend %s is unhealthy: %s", self.address, exc)
+            self.healthy = False
+            return False
+        close_connection(writer)
+        if not self.healthy:
+            LOGGER.info("Backend %s is healthy again", self.address)
+        self.healthy = True
+        return True
+
+    def close(self) -> None:
+        """Close all idle connections."""
+        for _, writer in self._idle:
+            close_connection(writer)
+        self._idle.clear()
+
+
+class LeastOutstandingRouter:
+    """Route to the backend with the fewest outstanding requests."""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, backends: Sequence[Backend]) -> None:
+        """Set up the router."""
+        self.backends = backends
+
+    # pylint: disable=unused-argument
+    def select(self, message: Message, exclude: Set[Backend]) -> Optional[Backend]:
+        """Return a backend for the message or None if none is available."""
+        candidates = [
+            backend
+            for backend in self.backends
+            if backend.healthy and backend not in exclude
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda backend: backend.outstanding)
+
+
+class ConsistentHashRouter:
+    """Route messages with the same key to the same backend.
+
+    The key is the value of ``hash_key`` in the message data if set and
+    present, otherwise the client id. Unhealthy backends are skipped by
+    walking the hash ring, so only their keys move to other backends.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(
+        self, backends: Sequence[Backend], hash_key: Optional[str] = None
+    ) -> None:
+        """Set up the router."""
+        self.backends = backends
+        self.hash_key = hash_key
+        ring = sorted(
+            (
+                (hash_value(f"{backend.address}-{index}"), backend)
+                for backend in backends
+                for index in range(VIRTUAL_NODES)
+            ),
+            key=lambda node: node[0],
+        )
+        self._ring_hashes = [value for value, _ in ring]
+        self._ring_backends = [backend for _, backend in ring]
+
+    def get_key(self, message: Message) -> str:
+        """Return the routing key of the message."""
+        if self.hash_key is not None and self.hash_key in message.data:
+            return str(message.data[self.hash_key])
+        return str(message.client)
+
+    def select(self, message: Message, exclude: Set[Backend]) -> Optional[Backend]:
+        """Return a backend for the message or None if none is available."""
+        if not self._ring_backends:
+            return None
+        start = bisect(self._ring_hashes, hash_value(self.get_key(message)))
+        size = len(self._ring_backends)
+        for index in range(size):
+            backend = self._ring_backends[(start + index) % size]
+            if backend.healthy and backend not in exclude:
+                return backend
+        return None
+
+
+class CPIAGateway(CPIAServer):
+    """Represent a gateway server that forwards messages to backend servers."""
+
+    # pylint: disable=too-many-arguments
+
+    def __init__(
+        self,
+        backends: Sequence[str],
+        *,
+        routing: str = ROUTING_LEAST_OUTSTANDING,
+        hash_key: Optional[str] = None,
+        retries: int = 2,
+        health_interval: float = 5.0,
+        request_timeout: Optional[float] = DEFAULT_REQUEST_TIMEOUT,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        **kwargs: Any,
+    ) -> None:
+        """Set up gateway instance.
+
+        A request that gets no reply within request_timeout seconds fails,
+        and frees its connection, since backends don't reply to unknown
+        commands. A backend that doesn't accept a connection within
+        connect_timeout seconds is unhealthy. The keyword arguments are
+        passed to the server.
+        """
+        super().__init__(**kwargs)
+        if routing not in ROUTINGS:
+            raise ValueError(f"Unknown routing {routing}, use one of {ROUTINGS}")
+        self.backends = [
+            Backend(address, max_connections, connect_timeout) for address in backends
+        ]
+        self.router: Union[LeastOutstandingRouter, ConsistentHashRouter]
+        if routing == ROUTING_HASH:
+            self.router = ConsistentHashRouter(self.backends, hash_key)
+        else:
+            self.router = LeastOutstandingRouter(self.backends)
+        self.retries = retries
+        self.health_interval = health_interval
+        self.request_timeout = request_timeout
+        self._health_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """Start gateway."""
+        await self.check_backends()
+        self._health_task = asyncio.create_task(self.health_check_loop())
+        self.on_stop(self._stop_backends)
+        await super().start()
+
+    def _stop_backends(self) -> None:
+        """Stop health checks and close backend connections."""
+        if self._health_task is not None:
+            self._health_task.cancel()
+        for backend in self.backends:
+            backend.close()
+
+    async def check_backends(self) -> None:
+        """Check the health of all backends."""
+        await asyncio.gather(*(backend.check_health() for backend in self.backends))
+
+    async def health_check_loop(self) -> None:
+        """Check the health of all backends periodically."""
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_backends()
+
+    def get_command(self, command_name: str) -> Optional[Callable]:
+        """Return the forward command for every command name."""
+        return self.forward_command
+
+    # pylint: disable=unused-argument
+    async def forward_command(
+        self, server: CPIAServer, message: Message, **data: Any
+    ) -> Message:
+        """Forward a message to a backend and return the reply.
+
+        File descriptors passed with the message are not forwarded.
+        """
+        if message.fds:
+            LOGGER.warning(
+                "Can't forward file descriptors to backends, dropping %s passed "
+                "with %s from %s",
+                len(message.fds),
+                message.command,
+                message.client,
+            )
+        return await self.forward(message)
+
+    async def forward(self, message: Message) -> Message:
+        """Forward a message to a backend and return the reply.
+
+        Retry on another backend if the connection to the backend fails,
+        but not if the request timed out. Return a message with the
+        unavailable command if no backend could handle it.
+        """
+        data = message.encode().encode()
+        tried: Set[Backend] = set()
+        for _ in range(self.retries + 1):
+            backend = self.router.select(message, tried)
+            if backend is None:
+                break
+            tried.add(backend)
+            try:
+                reply = await self._request(backend, data)
+            except asyncio.TimeoutError:
+                LOGGER.warning("Request to %s timed out", backend.address)
+                break
+            except BackendError as exc:
+                LOGGER.warning("Request to %s failed: %s", backend.address, exc)
+                continue
+            reply_msg = Message.decode(reply.decode())
+            if reply_msg is not None:
+                return reply_msg
+            LOGGER.error("Received invalid reply from %s", backend.address)
+
+        LOGGER.error("No backend could handle %s", message)
+        return Message(
+            client=message.client,
+            command=UNAVAILABLE_COMMAND,
+            data=message.data,
+            request_id=message.request_id,
+        )
+
+    async def _request(self, backend: Backend, data: bytes) -> bytes:
+        """Send data to a backend and mark it unhealthy on connection errors."""
+        try:
+            return await backend.request(data, self.request_timeout)
+        except asyncio.TimeoutError:
+            # This is a subclass of OSError since Python 3.11.
+            raise
+        except OSError as exc:
+            backend.healthy = False
+            raise BackendError(exc) from exc
+
+
+def hash_value(key: str) -> int:
+    """Return a stable hash of a key."""
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big")
+
+
+def close_connection(writer: Writer) -> None:
+    """Close a backend connection."""
+    try:
+        writer.close()
+    except OSError:
+        pass
@@ -3,19 +3,41 @@ from __future__ import annotations
 
 import json
 from enum import Enum
-from typing import Optional, cast
+from typing import List, Optional, Sequence, cast
 
 from .const import LOGGER
 
+# The optional request id is only encoded if it's set.
+REQUEST_ID_KEY = "rid"
+# Cancel the running request with the request id given in the data.
+CANCEL_COMMAND = "cancel"
+# Reply command of a request that was cancelled.
+CANCELLED_COMMAND = "cancelled"
+
 
 class Message:
     """Represent a client/server message."""
 
-    def __init__(self, *, client: str, command: str, data: dict) -> None:
-        """Set up message instance."""
+    def __init__(
+        self,
+        *,
+        client: str,
+        command: str,
+        data: dict,
+        request_id: Optional[str] = None,
+        fds: Sequence[int] = (),
+    ) -> None:
+        """Set up message instance.
+
+        The optional request id is used to match replies and cancel
+        requests. The file descriptors in fds are passed out of band over
+        Unix domain sockets and are not part of the encoded message.
+        """
         self.client = client
         self.command = command
         self.data = data
+        self.request_id = request_id
+        self.fds: List[int] = list(fds)
         self.copy = self.__copy__
 
     def __copy__(self) -> Message:
@@ -28,7 +50,7 @@ class Message:
         """Return the representation."""
         return (
             f"{type(self).__name__}(client={self.client}, command={self.command}, "
-            f"data={self.data})"
+            f"data={self.data}, request_id={self.request_id})"
         )
 
     @classmethod
@@ -46,11 +68,16 @@ class Message:
         params: dict = {
             block.name: parsed_data.get(block.value) for block in MessageBlock
         }
+        request_id = parsed_data.get(REQUEST_ID_KEY)
+        if request_id is not None:
+            params["request_id"] = str(request_id)
         return cls(**params)
 
     def encode(self) -> str:
         """Encode message into a data string."""
         compiled_msg = {attr.value: getattr(self, attr.name) for attr in MessageBlock}
+        if self.request_id is not None:
+            compiled_msg[REQUEST_ID_KEY] = self.request_id
         return f"{json.dumps(compiled_msg)}\n"
 
 
@@ -1,13 +1,17 @@
 """Provide process tools."""
 import asyncio
 import signal
+from collections import deque
+from itertools import count
 from multiprocessing import Pipe, Process
 from multiprocessing.connection import Connection
 from time import sleep
-from typing import TYPE_CHECKING, Any, Callable, Dict, Tuple
+from typing import TYPE_CHECKING, Any, Callable, Deque, Dict, Optional, Set, Tuple
 
+from cpias.affinity import init_worker
 from cpias.const import LOGGER
 from cpias.exceptions import CPIASError
+from cpias.executor import INTERNAL_EXECUTOR
 
 if TYPE_CHECKING:
     from cpias.server import CPIAServer
@@ -17,13 +21,40 @@ class ReceiveError(CPIASError):
     """Error raised when receving from a process failed."""
 
 
+JOB = "job"
+CANCEL = "cancel"
+PROCESS_JOBS_SKIPPED = "process_jobs_skipped"
+
+
 def create_process(
     server: "CPIAServer", create_callback: Callable, *args: Any
 ) -> Tuple[Callable, Callable]:
-    """Create a persistent process."""
+    """Create a persistent process.
+
+    Sending data returns a job id, that can be passed when receiving to get
+    the result of that job. Without a job id, the result of the oldest job
+    that the calling task sent is received. If receiving is cancelled, the
+    process is told to skip the job if it hasn't started it yet, and the
+    result of the job is discarded. The process is pinned to cpus from the
+    cpu layout of the server if set.
+    """
     parent_conn, child_conn = Pipe()
-    prc = Process(target=func_wrapper, args=(create_callback, child_conn, *args))
+    kwargs: Dict[str, Any] = {}
+    if server.cpu_layout is not None:
+        kwargs["cpus"] = server.cpu_layout.allocate(persistent=True)
+        kwargs["threads"] = server.cpu_layout.threads_per_worker
+    prc = Process(
+        target=func_wrapper, args=(create_callback, child_conn, *args), kwargs=kwargs
+    )
     prc.start()
+    job_ids = count()
+    outstanding: Set[int] = set()
+    abandoned: Set[int] = set()
+    results: Dict[int, Any] = {}
+    # Map job ids that aren't received yet to the task that sent them.
+    senders: Dict[int, Optional[asyncio.Task]] = {}
+    read_lock = asyncio.Lock()
+    pending_read: Optional[asyncio.Future] = None
 
     def stop_process() -> None:
         """Stop process."""
@@ -31,31 +62,99 @@ def create_process(
 
     server.on_stop(stop_process)
 
-    async def async_recv() -> Any:
-        """Receive data from the process connection asynchronously."""
-        while True:
-            if not prc.is_alive() or parent_conn.poll():
-                break
-            await asyncio.sleep(0.5)
-
-        if not prc.is_alive():
-            raise ReceiveError
+    def store_reply(future: asyncio.Future) -> None:
+        """Store a reply from the process for the receiver of its job."""
+        nonlocal pending_read
+        pending_read = None
+        if future.cancelled() or future.exception() is not None:
+            return
+        job_id, result, skipped = future.result()
+        outstanding.discard(job_id)
+        if skipped:
+            server.wasted_work_avoided[PROCESS_JOBS_SKIPPED] += 1
+        if job_id in abandoned:
+            abandoned.discard(job_id)
+            return
+        results[job_id] = result
+
+    async def recv_reply() -> None:
+        """Receive the next reply from the process."""
+        nonlocal pending_read
+        if pending_read is None:
+            while True:
+                if not prc.is_alive() or parent_conn.poll():
+                    break
+                await asyncio.sleep(0.5)
+
+            if not prc.is_alive():
+                raise ReceiveError
+            pending_read = server.add_executor_job(
+                parent_conn.recv, executor=INTERNAL_EXECUTOR
+            )
+            pending_read.add_done_callback(store_reply)
         try:
-            return await server.add_executor_job(parent_conn.recv)
+            # Shield the receive so a reply isn't lost if we're cancelled.
+            await asyncio.shield(pending_read)
         except EOFError as exc:
             LOGGER.debug("Nothing more to receive")
             raise ReceiveError from exc
 
-    async def async_send(data: Dict[Any, Any]) -> None:
-        """Send data to the process."""
-        parent_conn.send(data)
+    def oldest_job() -> int:
+        """Return the oldest job of the calling task, or of any task."""
+        caller = asyncio.current_task()
+        caller_jobs = [job_id for job_id, task in senders.items() if task is caller]
+        if caller_jobs:
+            return min(caller_jobs)
+        if senders:
+            return min(senders)
+        raise ReceiveError("No job to receive")
+
+    async def async_recv(job_id: Optional[int] = None) -> Any:
+        """Receive the result of a job from the process asynchronously."""
+        if job_id is None:
+            job_id = oldest_job()
+        senders.pop(job_id, None)
+        try:
+            while job_id not in results:
+                # Only one receiver reads from the connection at a time.
+                async with read_lock:
+                    if job_id not in results:
+                        await recv_reply()
+            return results.pop(job_id)
+        except asyncio.CancelledError:
+            results.pop(job_id, None)
+            if job_id in outstanding:
+                abandoned.add(job_id)
+                try:
+                    parent_conn.send((CANCEL, job_id))
+                except (OSError, ValueError):
+                    LOGGER.debug("Failed to cancel job %s", job_id)
+            raise
+
+    async def async_send(data: Dict[Any, Any]) -> int:
+        """Send data to the process and return the job id."""
+        job_id = next(job_ids)
+        outstanding.add(job_id)
+        senders[job_id] = asyncio.current_task()
+        parent_conn.send((JOB, job_id, data))
+        return job_id
 
     return async_recv, async_send
 
 
-def func_wrapper(create_callback: Callable, conn: Connection, *args: Any) -> None:
+def func_wrapper(
+    create_callback: Callable,
+    conn: Connection,
+    *args: Any,
+    cpus: Optional[Set[int]] = None,
+    threads: Optional[int] = None,
+) -> None:
     """Wrap a function with connection to receive and send data."""
+    if cpus is not None or threads is not None:
+        init_worker(cpus, threads)
     running = True
+    jobs: Deque[Tuple[int, Any]] = deque()
+    cancelled: Set[int] = set()
 
     # pylint: disable=unused-argument
     def handle_signal(signum: int, frame: Any) -> None:
@@ -73,31 +172,48 @@ def func_wrapper(create_callback: Callable, conn: Connection, *args: Any) -> Non
         LOGGER.error("Failed to create callback: %s", exc)
         return
 
+    def receive_all() -> None:
+        """Receive all jobs and cancel requests that are waiting."""
+        while conn.poll():
+            kind, job_id, *data = conn.recv()
+            if kind == CANCEL:
+                cancelled.add(job_id)
+            else:
+                jobs.append((job_id, data[0]))
+
     while running:
 
-        while running:
+        while running and not jobs:
             if conn.poll():
                 break
             sleep(0.5)
 
         try:
-            data = conn.recv()
+            receive_all()
         except EOFError:
             LOGGER.debug("Nothing more to receive")
             break
         except OSError:
             LOGGER.debug("Connection is closed")
             break
-        try:
-            result = callback(data)
-        except Exception as exc:  # pylint: disable=broad-except
-            LOGGER.error("Failed to run callback: %s", exc)
-            break
+        if not jobs:
+            continue
+
+        job_id, data = jobs.popleft()
+        skipped = job_id in cancelled
+        cancelled.discard(job_id)
+        result = None
+        if not skipped:
+            try:
+                result = callback(data)
+            except Exception as exc:  # pylint: disable=broad-except
+                LOGGER.error("Failed to run callback: %s", exc)
+                break
 
         if not running:
             break
         try:
-            conn.send(result)
+            conn.send((job_id, result, skipped))
         except ValueError:
             LOGGER.error("Failed to send result %s", result)
         except OSError:
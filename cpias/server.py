@@ -1,12 +1,32 @@
 """Provide an image analysis server."""
 import asyncio
-import concurrent.futures
 import logging
-from typing import Any, Callable, Coroutine, Dict, Optional
+from collections import Counter
+from contextlib import AsyncExitStack
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple, Union
 
+from .affinity import CPULayout, init_worker
+from .capture import CaptureWriter
 from .commands import get_commands
 from .const import API_VERSION, LOGGER, VERSION
-from .message import Message
+from .executor import (
+    DEFAULT_EXECUTOR,
+    INTERNAL_EXECUTOR,
+    INTERNAL_EXECUTOR_SIZE,
+    KIND_PROCESS,
+    KIND_THREAD,
+    PROCESS_EXECUTOR,
+    NamedExecutor,
+    current_executor,
+)
+from .message import CANCEL_COMMAND, CANCELLED_COMMAND, REQUEST_ID_KEY, Message
+from .unix import UnixReader, UnixServer, UnixWriter, close_fds, start_unix_server
+
+Reader = Union[asyncio.StreamReader, UnixReader]
+Writer = Union[asyncio.StreamWriter, UnixWriter]
+
+CANCEL_REASON_DISCONNECT = "commands_cancelled_on_disconnect"
+CANCEL_REASON_MESSAGE = "commands_cancelled_by_request"
 
 
 class CPIAServer:
@@ -14,13 +34,45 @@ class CPIAServer:
 
     # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, host: str = "localhost", port: int = 8555) -> None:
-        """Set up server instance."""
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 8555,
+        unix_path: Optional[str] = None,
+        tcp: bool = True,
+        capture: Optional[CaptureWriter] = None,
+        cpu_layout: Optional[CPULayout] = None,
+        cancel_on_eof: bool = False,
+    ) -> None:
+        """Set up server instance.
+
+        Listen on TCP host and port if tcp is True, and on a Unix domain
+        socket at unix_path if it is set. Record incoming messages with
+        capture if it is set. Pin the server to the reserved cpus and worker
+        processes to the other cpus of cpu_layout if it is set. Cancel the
+        running command when the client closes its side of the connection
+        if cancel_on_eof is True, otherwise only if the connection is lost.
+        """
+        if not tcp and unix_path is None:
+            raise ValueError("The server needs at least one transport")
         self.host = host
         self.port = port
+        self.unix_path = unix_path
+        self.tcp = tcp
+        self.capture = capture
+        self.cpu_layout = cpu_layout
+        self.cancel_on_eof = cancel_on_eof
         self.server: Optional[asyncio.AbstractServer] = None
+        self.unix_server: Optional[UnixServer] = None
         self.serv_task: Optional[asyncio.Task] = None
         self.commands: Dict[str, Callable] = {}
+        self.command_executors: Dict[str, str] = {}
+        self.executors: Dict[str, NamedExecutor] = {}
+        self.register_executor(DEFAULT_EXECUTOR)
+        self.register_executor(PROCESS_EXECUTOR, KIND_PROCESS)
+        self.register_executor(INTERNAL_EXECUTOR, max_workers=INTERNAL_EXECUTOR_SIZE)
+        self._running_commands: Dict[Tuple[str, Optional[str]], asyncio.Task] = {}
+        self.wasted_work_avoided: Dict[str, int] = Counter()
         self._on_stop_callbacks: list = []
         self._pending_tasks: list = []
         self._track_tasks = False
@@ -33,14 +85,29 @@ class CPIAServer:
         for module in commands.values():
             module.register_command(self)  # type: ignore
 
-        server = await asyncio.start_server(
-            self.handle_conn, host=self.host, port=self.port
-        )
-        self.server = server
-
-        async with server:
-            self.serv_task = asyncio.create_task(server.serve_forever())
-            LOGGER.info("Serving at %s:%s", self.host, self.port)
+        if self.capture is not None:
+            self.on_stop(self.capture.close)
+
+        if self.cpu_layout is not None and self.cpu_layout.reserved_cpus:
+            # Keep the event loop and the thread pools on the reserved cpus.
+            init_worker(set(self.cpu_layout.reserved_cpus), None)
+
+        async with AsyncExitStack() as stack:
+            servers: List[Union[asyncio.AbstractServer, UnixServer]] = []
+            if self.tcp:
+                server = await asyncio.start_server(
+                    self.handle_conn, host=self.host, port=self.port
+                )
+                self.server = await stack.enter_async_context(server)
+                servers.append(server)
+                LOGGER.info("Serving at %s:%s", self.host, self.port)
+            if self.unix_path is not None:
+                unix_server = await start_unix_server(self.handle_conn, self.unix_path)
+                self.unix_server = await stack.enter_async_context(unix_server)
+                servers.append(unix_server)
+                LOGGER.info("Serving at unix socket %s", self.unix_path)
+
+            self.serv_task = asyncio.create_task(serve_forever(servers))
             await self.serv_task
 
     async def stop(self) -> None:
@@ -53,6 +120,9 @@ class CPIAServer:
         self._on_stop_callbacks.clear()
         await self.wait_for_tasks()
 
+        for executor in self.executors.values():
+            executor.shutdown()
+
         if self.serv_task is not None:
             self.serv_task.cancel()
             await asyncio.sleep(0)  # Let the event loop cancel the task.
@@ -61,13 +131,34 @@ class CPIAServer:
         """Register a callback that should be called on server stop."""
         self._on_stop_callbacks.append(callback)
 
-    def register_command(self, command_name: str, command_func: Callable) -> None:
-        """Register a command function."""
+    def register_command(
+        self, command_name: str, command_func: Callable, executor: Optional[str] = None
+    ) -> None:
+        """Register a command function.
+
+        Jobs that the command runs with add_executor_job or run_process_job
+        use the named executor if it's set and of the matching kind.
+        """
+        if executor is not None and executor not in self.executors:
+            raise ValueError(f"Unknown executor {executor}")
         self.commands[command_name] = command_func
+        if executor is not None:
+            self.command_executors[command_name] = executor
 
-    async def handle_conn(
-        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    def register_executor(
+        self, name: str, kind: str = KIND_THREAD, max_workers: Optional[int] = None
     ) -> None:
+        """Register a named thread or process pool executor."""
+        if name in self.executors:
+            raise ValueError(f"Executor {name} is already registered")
+        layout = self.cpu_layout if kind == KIND_PROCESS else None
+        self.executors[name] = NamedExecutor(name, kind, max_workers, layout)
+
+    def get_command(self, command_name: str) -> Optional[Callable]:
+        """Return the command function for a command name if registered."""
+        return self.commands.get(command_name)
+
+    async def handle_conn(self, reader: Reader, writer: Writer) -> None:
         """Handle a connection."""
         # Send server version and server api version as welcome message.
         version_msg = f"CPIAServer version: {VERSION}, api version: {API_VERSION}\n"
@@ -78,62 +169,259 @@ class CPIAServer:
 
         LOGGER.debug("Closing the connection")
         writer.close()
-        await writer.wait_closed()
-
-    async def handle_comm(
-        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
-    ) -> None:
-        """Handle communication between client and server."""
+        try:
+            await writer.wait_closed()
+        except ConnectionError as exc:
+            LOGGER.debug("Connection lost: %s", exc)
+
+    async def handle_comm(self, reader: Reader, writer: Writer) -> None:
+        """Handle communication between client and server.
+
+        File descriptors received with a message over a Unix domain socket
+        are available as ``message.fds`` and are closed when the command
+        returns. File descriptors that the command adds to the reply are
+        sent to the client and then closed.
+        """
         addr = writer.get_extra_info("peername")
-        while True:
-            data = await reader.readline()
-            if not data:
-                break
-            msg = Message.decode(data.decode())
-            if not msg:
-                # TODO: Send invalid message message.  # pylint: disable=fixme
-                continue
-
-            cmd_func = self.commands.get(msg.command)
-
-            if cmd_func is None:
-                LOGGER.warning("Received unknown command %s from %s", msg.command, addr)
-                # TODO: Send unknown command message.  # pylint: disable=fixme
-                continue
-
-            LOGGER.debug("Received %s from %s", msg, addr)
-            LOGGER.debug("Executing command %s", msg.command)
-
-            reply = await cmd_func(self, msg, **msg.data)
+        capture = self.capture
+        conn_id = capture.new_connection() if capture is not None else None
+        read_task: Optional[asyncio.Task] = None
+        try:
+            while True:
+                if read_task is None:
+                    read_task = asyncio.create_task(read_line(reader))
+                try:
+                    data, fds = await read_task
+                except ConnectionError as exc:
+                    LOGGER.debug("Connection lost: %s", exc)
+                    break
+                finally:
+                    read_task = None
+                if not data:
+                    break
+                msg = Message.decode(data.decode())
+                if not msg:
+                    close_fds(fds)
+                    # TODO: Send invalid message message.  # pylint: disable=fixme
+                    continue
+
+                msg.fds = fds
+
+                if msg.command == CANCEL_COMMAND:
+                    close_fds(fds)
+                    self.handle_cancel(msg, conn_id)
+                    continue
+
+                cmd_func = self.get_command(msg.command)
+
+                if cmd_func is None:
+                    close_fds(fds)
+                    LOGGER.warning(
+                        "Received unknown command %s from %s", msg.command, addr
+                    )
+                    # TODO: Send unknown command message.  # pylint: disable=fixme
+                    continue
+
+                # Only record dispatched commands, since others get no reply.
+                if capture is not None and conn_id is not None:
+                    capture.record(conn_id, msg)
+
+                LOGGER.debug("Received %s from %s", msg, addr)
+                LOGGER.debug("Executing command %s", msg.command)
+
+                reply_fds: List[int] = []
+                try:
+                    reply, read_task = await self.run_command(
+                        cmd_func, msg, reader, writer, conn_id
+                    )
+                    if reply is None:
+                        continue
+                    # Only send file descriptors that the command added.
+                    reply_fds = [fd for fd in reply.fds if fd not in fds]
+                    LOGGER.debug("Sending: %s", reply)
+                    data = reply.encode().encode()
+                    if isinstance(writer, UnixWriter):
+                        writer.write(data, reply_fds)
+                    else:
+                        if reply_fds:
+                            LOGGER.warning("Can't send file descriptors over tcp")
+                        writer.write(data)
+                    await writer.drain()
+                except ConnectionError as exc:
+                    LOGGER.debug("Connection lost: %s", exc)
+                    break
+                finally:
+                    close_fds(list(set(fds) | set(reply_fds)))
+        finally:
+            if read_task is not None:
+                read_task.cancel()
+
+    async def run_command(
+        self,
+        cmd_func: Callable,
+        msg: Message,
+        reader: Reader,
+        writer: Writer,
+        conn_id: Optional[int] = None,
+    ) -> Tuple[Optional[Message], asyncio.Task]:
+        """Run a command while watching the connection.
+
+        Cancel the command if the connection is lost, or if a cancel
+        message for the request is received. A client that only closes its
+        side of the connection still gets the reply, unless cancel_on_eof
+        is set. Return the reply, which is None if the command is cancelled
+        on disconnect, and the task reading the next line. The conn_id is
+        the capture connection id of the connection if set.
+        """
+        token = current_executor.set(self.command_executors.get(msg.command))
+        try:
+            cmd_task = asyncio.create_task(cmd_func(self, msg, **msg.data))
+        finally:
+            current_executor.reset(token)
+
+        key = (msg.client, msg.request_id)
+        if msg.request_id is not None:
+            self._running_commands[key] = cmd_task
+        read_task = asyncio.create_task(read_line(reader))
+        try:
+            while True:
+                await asyncio.wait(
+                    {cmd_task, read_task}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if cmd_task.done():
+                    break
+                try:
+                    data, fds = read_task.result()
+                except ConnectionError as exc:
+                    LOGGER.debug("Connection lost: %s", exc)
+                    await self.cancel_on_disconnect(cmd_task, msg)
+                    return None, read_task
+                if not data:
+                    if self.cancel_on_eof or writer.is_closing():
+                        await self.cancel_on_disconnect(cmd_task, msg)
+                        return None, read_task
+                    # The client may still wait for the reply.
+                    await asyncio.wait({cmd_task})
+                    break
+                next_msg = Message.decode(data.decode())
+                if next_msg is None or next_msg.command != CANCEL_COMMAND:
+                    # Handle the next message when the command is done.
+                    await asyncio.wait({cmd_task})
+                    break
+                close_fds(fds)
+                self.handle_cancel(next_msg, conn_id)
+                read_task = asyncio.create_task(read_line(reader))
+        except BaseException:
+            cmd_task.cancel()
+            read_task.cancel()
+            raise
+        finally:
+            if self._running_commands.get(key) is cmd_task:
+                del self._running_commands[key]
+
+        if cmd_task.cancelled():
+            reply = Message(
+                client=msg.client,
+                command=CANCELLED_COMMAND,
+                data={},
+                request_id=msg.request_id,
+            )
+            return reply, read_task
+        try:
+            return cmd_task.result(), read_task
+        except BaseException:
+            read_task.cancel()
+            raise
+
+    async def cancel_on_disconnect(self, cmd_task: asyncio.Task, msg: Message) -> None:
+        """Cancel a running command because its client is gone."""
+        LOGGER.debug("Connection lost, cancelling %s", msg.command)
+        cmd_task.cancel()
+        self.wasted_work_avoided[CANCEL_REASON_DISCONNECT] += 1
+        await asyncio.wait({cmd_task})
+        if not cmd_task.cancelled() and cmd_task.exception():
+            LOGGER.debug("Command %s failed after cancel", msg.command)
+
+    def handle_cancel(self, msg: Message, conn_id: Optional[int] = None) -> None:
+        """Handle a cancel message.
+
+        The request id to cancel is read from the message data, and
+        defaults to the request id of the cancel message itself.
+        """
+        if self.capture is not None and conn_id is not None:
+            self.capture.record(conn_id, msg)
+        request_id = msg.request_id
+        if isinstance(msg.data, dict) and msg.data.get(REQUEST_ID_KEY) is not None:
+            request_id = str(msg.data[REQUEST_ID_KEY])
+        self.cancel_request(msg.client, request_id)
 
-            LOGGER.debug("Sending: %s", reply)
-            data = reply.encode().encode()
-            writer.write(data)
-            await writer.drain()
+    def cancel_request(self, client: str, request_id: Optional[str]) -> bool:
+        """Cancel the running command of a client request.
 
-    def add_executor_job(self, func: Callable, *args: Any) -> Coroutine:
-        """Schedule a function to be run in the thread pool.
+        Return True if a command was cancelled.
+        """
+        cmd_task = self._running_commands.pop((client, request_id), None)
+        if cmd_task is None or cmd_task.done():
+            LOGGER.debug("No running request %s of %s to cancel", request_id, client)
+            return False
+        LOGGER.debug("Cancelling request %s of %s", request_id, client)
+        cmd_task.cancel()
+        self.wasted_work_avoided[CANCEL_REASON_MESSAGE] += 1
+        return True
+
+    def get_executor(self, kind: str, name: Optional[str] = None) -> NamedExecutor:
+        """Return the executor to use for a job of kind.
+
+        Use the named executor if given, otherwise the executor of the
+        running command if it's of kind, otherwise the default of kind.
+        """
+        if name is not None:
+            return self.executors[name]
+        command_executor = current_executor.get()
+        if command_executor is not None:
+            executor = self.executors[command_executor]
+            if executor.kind == kind:
+                return executor
+        if kind == KIND_PROCESS:
+            return self.executors[PROCESS_EXECUTOR]
+        return self.executors[DEFAULT_EXECUTOR]
+
+    def add_executor_job(
+        self, func: Callable, *args: Any, executor: Optional[str] = None
+    ) -> asyncio.Future:
+        """Schedule a function to be run in a thread pool.
 
         Return a task.
         """
-        loop = asyncio.get_running_loop()
-        task = loop.run_in_executor(None, func, *args)
+        task = self.get_executor(KIND_THREAD, executor).submit(func, *args)
         if self._track_tasks:
             self._pending_tasks.append(task)
 
         return task
 
-    async def run_process_job(self, func: Callable, *args: Any) -> Any:
-        """Run a job in the process pool."""
-        loop = asyncio.get_running_loop()
+    async def run_process_job(
+        self, func: Callable, *args: Any, executor: Optional[str] = None
+    ) -> Any:
+        """Run a job in a process pool."""
+        task = self.get_executor(KIND_PROCESS, executor).submit(func, *args)
+        if self._track_tasks:
+            self._pending_tasks.append(task)
 
-        with concurrent.futures.ProcessPoolExecutor() as pool:
-            task = loop.run_in_executor(pool, func, *args)
-            if self._track_tasks:
-                self._pending_tasks.append(task)
-            result = await task
+        return await task
 
-        return result
+    def metrics(self) -> Dict[str, Any]:
+        """Return server metrics."""
+        executor_stats = {
+            name: executor.stats() for name, executor in self.executors.items()
+        }
+        wasted_work_avoided = dict(self.wasted_work_avoided)
+        wasted_work_avoided["executor_jobs_cancelled"] = sum(
+            stats["cancelled"] for stats in executor_stats.values()
+        )
+        return {
+            "executors": executor_stats,
+            "wasted_work_avoided": wasted_work_avoided,
+        }
 
     def create_task(self, coro: Coroutine) -> asyncio.Task:
         """Schedule a coroutine on the event loop.
@@ -161,6 +449,20 @@ class CPIAServer:
                 await asyncio.sleep(0)
 
 
+async def read_line(reader: Reader) -> Tuple[bytes, List[int]]:
+    """Read a line and return it with the file descriptors sent with it."""
+    data = await reader.readline()
+    fds = reader.last_fds if isinstance(reader, UnixReader) else []
+    return data, fds
+
+
+async def serve_forever(
+    servers: List[Union[asyncio.AbstractServer, UnixServer]]
+) -> None:
+    """Serve on all servers until cancelled."""
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
 def main() -> None:
     """Run server."""
     logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
@@ -0,0 +1,323 @@
+"""Provide a Unix domain socket transport with file descriptor passing.
+
+The asyncio stream transports read with ``recv`` and drop ancillary data,
+so file descriptors sent with ``SCM_RIGHTS`` would be lost. This module
+provides a small reader, writer and server on top of non-blocking sockets,
+that mirror the subset of the asyncio streams API used by the server and
+the client, and that keep track of which received line each passed file
+descriptor belongs to.
+"""
+import array
+import asyncio
+import os
+import socket
+import stat
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from cpias.const import LOGGER
+
+BUFFER_SIZE = 2 ** 16
+# Same default line limit as the asyncio stream reader.
+LINE_LIMIT = 2 ** 16
+MAX_FDS = 16
+
+
+class UnixReader:
+    """Represent a line reader that also receives file descriptors."""
+
+    def __init__(self, sock: socket.socket, limit: int = LINE_LIMIT) -> None:
+        """Set up the reader."""
+        self._sock = sock
+        self._limit = limit
+        self._buffer = bytearray()
+        self._eof = False
+        # Stream offset of the first byte in the buffer.
+        self._offset = 0
+        # Stream offsets of line starts mapped to file descriptors.
+        self._fds: Dict[int, List[int]] = {}
+        self.last_fds: List[int] = []
+
+    async def readline(self) -> bytes:
+        """Read one line and return it.
+
+        The file descriptors sent together with the line are stored in
+        the ``last_fds`` attribute. Return an empty bytes object on EOF.
+        Raise ValueError if the line is longer than the limit.
+        """
+        while True:
+            index = self._buffer.find(b"\n")
+            if index >= 0 or self._eof:
+                break
+            if len(self._buffer) > self._limit:
+                self._offset += len(self._buffer)
+                self._buffer.clear()
+                self.close()
+                raise ValueError("Separator is not found, and chunk exceed the limit")
+            await self._recv()
+
+        end = index + 1 if index >= 0 else len(self._buffer)
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        start = self._offset
+        self._offset += end
+        self.last_fds = self._fds.pop(start, [])
+        return line
+
+    async def _recv(self) -> None:
+        """Receive data and file descriptors from the socket."""
+        loop = asyncio.get_running_loop()
+        ancbufsize = socket.CMSG_SPACE(MAX_FDS * array.array("i").itemsize)
+        while True:
+            try:
+                data, ancdata, flags, _ = self._sock.recvmsg(BUFFER_SIZE, ancbufsize)
+                break
+            except (BlockingIOError, InterruptedError):
+                await _wait_fd(loop.add_reader, loop.remove_reader, self._sock)
+            except ConnectionError:
+                data, ancdata, flags = b"", [], 0
+                break
+
+        fds = _parse_fds(ancdata)
+        if flags & socket.MSG_CTRUNC:
+            LOGGER.error("Received too many file descriptors, max is %s", MAX_FDS)
+            close_fds(fds)
+            fds = []
+
+        if not data:
+            close_fds(fds)
+            self._eof = True
+            return
+
+        if fds:
+            # The kernel delivers the file descriptors with the chunk that
+            # holds the first byte of the sendmsg call that sent them,
+            # so they belong to the last line starting in this chunk.
+            chunk_start = self._offset + len(self._buffer)
+            line_start = chunk_start + data.rfind(b"\n", 0, len(data) - 1) + 1
+            if line_start == chunk_start:
+                line_start = self._line_start()
+            self._fds.setdefault(line_start, []).extend(fds)
+
+        self._buffer.extend(data)
+
+    def _line_start(self) -> int:
+        """Return the stream offset where the current partial line starts."""
+        return self._offset + self._buffer.rfind(b"\n") + 1
+
+    def close(self) -> None:
+        """Close file descriptors that were never handed to a line."""
+        for fds in self._fds.values():
+            close_fds(fds)
+        self._fds.clear()
+
+
+class UnixWriter:
+    """Represent a writer that can also send file descriptors."""
+
+    def __init__(self, sock: socket.socket) -> None:
+        """Set up the writer."""
+        self._sock = sock
+        self._queue: List[Tuple[bytes, Sequence[int]]] = []
+        self._closed = False
+
+    def get_extra_info(self, name: str, default: Any = None) -> Any:
+        """Return transport information like the asyncio stream writer."""
+        if name == "socket":
+            return self._sock
+        if name == "sockname":
+            return self._sock.getsockname()
+        if name == "peername":
+            try:
+                return self._sock.getpeername() or "unix"
+            except OSError:
+                return default
+        return default
+
+    def write(self, data: bytes, fds: Sequence[int] = ()) -> None:
+        """Queue data, and optionally file descriptors, to be sent."""
+        self._queue.append((data, fds))
+
+    async def drain(self) -> None:
+        """Send all queued data."""
+        loop = asyncio.get_running_loop()
+        while self._queue:
+            data, fds = self._queue.pop(0)
+            view = memoryview(data)
+            ancdata = []
+            if fds:
+                fds_array = array.array("i", fds)
+                ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds_array)]
+            while view or ancdata:
+                try:
+                    sent = self._sock.sendmsg([view], ancdata)
+                except (BlockingIOError, InterruptedError):
+                    await _wait_fd(loop.add_writer, loop.remove_writer, self._sock)
+                    continue
+                # The file descriptors are sent with the first chunk only.
+                ancdata = []
+                view = view[sent:]
+
+    def close(self) -> None:
+        """Close the socket."""
+        if self._closed:
+            return
+        self._closed = True
+        self._sock.close()
+
+    def is_closing(self) -> bool:
+        """Return True if the writer is closed."""
+        return self._closed
+
+    async def wait_closed(self) -> None:
+        """Wait until the writer is closed."""
+        await asyncio.sleep(0)
+
+
+class UnixServer:
+    """Represent a Unix domain socket server with file descriptor passing."""
+
+    def __init__(
+        self,
+        client_connected_cb: Callable[[UnixReader, UnixWriter], Coroutine],
+        path: str,
+    ) -> None:
+        """Set up the server."""
+        self.client_connected_cb = client_connected_cb
+        self.path = path
+        self._sock: Optional[socket.socket] = None
+        self._conn_tasks: Set[asyncio.Task] = set()
+
+    async def __aenter__(self) -> "UnixServer":
+        """Enter the server context."""
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        """Exit the server context and close the server."""
+        self.close()
+        await self.wait_closed()
+
+    def start(self) -> None:
+        """Bind the socket and start listening."""
+        remove_stale_socket(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(100)
+        sock.setblocking(False)
+        self._sock = sock
+
+    async def serve_forever(self) -> None:
+        """Accept connections until cancelled."""
+        if self._sock is None:
+            self.start()
+        assert self._sock is not None
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, _ = await loop.sock_accept(self._sock)
+            conn.setblocking(False)
+            task = asyncio.create_task(self._handle(conn))
+            self._conn_tasks.add(task)
+            task.add_done_callback(self._conn_tasks.discard)
+
+    async def _handle(self, conn: socket.socket) -> None:
+        """Handle a connection."""
+        reader = UnixReader(conn)
+        writer = UnixWriter(conn)
+        try:
+            await self.client_connected_cb(reader, writer)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception("Unexpected error while handling unix connection")
+        finally:
+            reader.close()
+            writer.close()
+
+    def close(self) -> None:
+        """Stop listening and remove the socket file."""
+        if self._sock is None:
+            return
+        self._sock.close()
+        self._sock = None
+        remove_stale_socket(self.path)
+        for task in self._conn_tasks:
+            task.cancel()
+
+    async def wait_closed(self) -> None:
+        """Wait until all connections are closed."""
+        if self._conn_tasks:
+            await asyncio.wait(list(self._conn_tasks))
+
+
+async def start_unix_server(
+    client_connected_cb: Callable[[UnixReader, UnixWriter], Coroutine], path: str,
+) -> UnixServer:
+    """Start a Unix domain socket server and return it."""
+    server = UnixServer(client_connected_cb, path)
+    server.start()
+    return server
+
+
+async def open_unix_connection(path: str) -> Tuple[UnixReader, UnixWriter]:
+    """Open a connection to a Unix domain socket and return reader and writer."""
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, path)
+    except OSError:
+        sock.close()
+        raise
+    return UnixReader(sock), UnixWriter(sock)
+
+
+def remove_stale_socket(path: str) -> None:
+    """Remove a socket file left behind at path, if any."""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def close_fds(fds: Sequence[int]) -> None:
+    """Close file descriptors, ignoring the ones already closed."""
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+def _parse_fds(ancdata: List[Tuple[int, int, bytes]]) -> List[int]:
+    """Return the file descriptors found in ancillary data."""
+    fds = array.array("i")
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            usable = len(data) - (len(data) % fds.itemsize)
+            fds.frombytes(data[:usable])
+    return list(fds)
+
+
+async def _wait_fd(add: Callable, remove: Callable, sock: socket.socket) -> None:
+    """Wait until the socket is ready for reading or writing."""
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    def ready() -> None:
+        """Mark the socket as ready."""
+        if not fut.done():
+            fut.set_result(None)
+
+    add(sock.fileno(), ready)
+    try:
+        await fut
+    finally:
+        remove(sock.fileno())
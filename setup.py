@@ -24,10 +24,14 @@ setup(
     packages=find_packages(exclude=["contrib", "docs", "tests*"]),
     python_requires=">=3.7",
     install_requires=["click", "voluptuous"],
+    extras_require={"affinity": ["threadpoolctl"]},
     include_package_data=True,
     entry_points={
         "console_scripts": ["cpias = cpias.cli:cli"],
-        "cpias.commands": ["hello = cpias.commands.hello"],
+        "cpias.commands": [
+            "hello = cpias.commands.hello",
+            "metrics = cpias.commands.metrics",
+        ],
     },
     license="Apache-2.0",
     zip_safe=False,
@@ -0,0 +1,49 @@
+"""Provide common test fixtures."""
+import asyncio
+
+import pytest
+
+
+class ServerRunner:
+    """Start servers on the running event loop and stop them on exit."""
+
+    def __init__(self):
+        """Set up the runner."""
+        self.tasks = {}
+
+    async def __aenter__(self):
+        """Return the runner."""
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """Stop the servers that are still running, the last started first."""
+        for server in reversed(list(self.tasks)):
+            await self.stop(server)
+
+    async def start(self, server):
+        """Start a server and wait until it's serving."""
+        task = asyncio.create_task(server.start())
+        self.tasks[server] = task
+        while server.serv_task is None:
+            if task.done():
+                # Raise the error that stopped the server from starting.
+                task.result()
+            await asyncio.sleep(0.01)
+        return server
+
+    async def stop(self, server):
+        """Stop a server and wait until it's closed."""
+        await server.stop()
+        await asyncio.wait([self.tasks.pop(server)], timeout=1)
+
+
+@pytest.fixture
+def servers():
+    """Return a runner that starts and stops servers."""
+    return ServerRunner()
+
+
+@pytest.fixture
+def sock_path(tmp_path):
+    """Return a unix socket path for a server."""
+    return str(tmp_path / "cpias.sock")
@@ -0,0 +1,102 @@
+"""Provide tests for cpu affinity."""
+import asyncio
+import os
+import sys
+
+from cpias.affinity import THREAD_LIMIT_ENV_VARS, CPULayout, init_worker
+from cpias.executor import KIND_PROCESS, NamedExecutor
+from cpias.server import CPIAServer
+
+
+def worker_info():
+    """Return the cpu affinity and thread limit of the worker."""
+    return sorted(os.sched_getaffinity(0)), os.environ.get("OMP_NUM_THREADS")
+
+
+def test_layout_splits_cpus():
+    """Test that worker cpu sets are disjoint and skip reserved cores."""
+    layout = CPULayout(cores_per_worker=3, reserved_cores=2, cpus=range(10))
+
+    assert layout.reserved_cpus == [0, 1]
+    assert layout.worker_sets == [{2, 3, 4}, {5, 6, 7}]
+    assert layout.max_workers == 2
+    assert layout.threads_per_worker == 3
+    assert [layout.allocate() for _ in range(3)] == [{2, 3, 4}, {5, 6, 7}, {2, 3, 4}]
+
+
+def test_layout_persistent_workers():
+    """Test that cpu sets are kept for persistent processes."""
+    layout = CPULayout(
+        cores_per_worker=2, reserved_cores=0, cpus=range(6), persistent_workers=1
+    )
+
+    assert layout.max_workers == 2
+    assert layout.allocate(persistent=True) == {4, 5}
+    assert [layout.allocate() for _ in range(2)] == [{0, 1}, {2, 3}]
+    assert layout.free_pool_sets == 0
+
+
+def test_layout_leaves_used_sets():
+    """Test that workers get unused cpu sets before sharing one."""
+    layout = CPULayout(cores_per_worker=1, reserved_cores=0, cpus=range(3))
+
+    assert layout.allocate(persistent=True) == {0}
+    assert layout.free_pool_sets == 2
+    assert [layout.allocate() for _ in range(3)] == [{1}, {2}, {0}]
+
+
+def test_layout_too_few_cpus():
+    """Test that workers share all cpus if there are too few to reserve."""
+    layout = CPULayout(cores_per_worker=4, reserved_cores=1, cpus=[0, 1])
+
+    assert layout.worker_sets == [{0, 1}]
+
+
+def test_thread_limit_without_threadpoolctl(monkeypatch, caplog):
+    """Test that a missing threadpoolctl is warned about."""
+    for env_var in THREAD_LIMIT_ENV_VARS:
+        monkeypatch.setenv(env_var, "")
+    monkeypatch.setitem(sys.modules, "threadpoolctl", None)
+
+    init_worker(None, 2)
+
+    assert os.environ["OMP_NUM_THREADS"] == "2"
+    assert "threadpoolctl isn't installed" in caplog.text
+
+
+def test_pinned_process_pool():
+    """Test that process pool workers are pinned and thread limited."""
+    cpus = sorted(os.sched_getaffinity(0))
+    layout = CPULayout(cores_per_worker=1, reserved_cores=0, threads_per_worker=2)
+    executor = NamedExecutor("test", KIND_PROCESS, layout=layout)
+
+    async def run():
+        result = await executor.submit(worker_info)
+        executor.shutdown()
+        return result
+
+    affinity, threads = asyncio.run(run())
+
+    assert set(affinity) in layout.worker_sets
+    assert len(affinity) == 1
+    assert threads == "2"
+    assert executor.max_workers == len(cpus)
+
+
+def test_server_pinned_to_reserved_cpus(servers, sock_path):
+    """Test that the server process is pinned to the reserved cpus."""
+    cpus = sorted(os.sched_getaffinity(0))
+    layout = CPULayout(cores_per_worker=1, reserved_cores=1)
+    server = CPIAServer(unix_path=sock_path, tcp=False, cpu_layout=layout)
+
+    async def run():
+        async with servers:
+            await servers.start(server)
+            return sorted(os.sched_getaffinity(0))
+
+    try:
+        affinity = asyncio.run(run())
+    finally:
+        os.sched_setaffinity(0, cpus)
+
+    assert affinity == layout.reserved_cpus
@@ -0,0 +1,235 @@
+"""Provide tests for cancelling commands."""
+import asyncio
+import socket
+import struct
+import time
+
+from cpias.capture import CaptureWriter, read_capture
+from cpias.message import CANCELLED_COMMAND, Message
+from cpias.process import create_process
+from cpias.server import CANCEL_REASON_DISCONNECT, CANCEL_REASON_MESSAGE, CPIAServer
+from cpias.unix import open_unix_connection
+
+
+def create_sleeper():
+    """Return a callback that sleeps before replying."""
+
+    def sleeper(seconds):
+        """Sleep and return the seconds."""
+        time.sleep(seconds)
+        return seconds
+
+    return sleeper
+
+
+def create_server(sock_path, **kwargs):
+    """Return a server with a command that waits until cancelled."""
+    kwargs.setdefault("tcp", False)
+    server = CPIAServer(unix_path=sock_path, **kwargs)
+    server.store["cancelled"] = asyncio.Event()
+
+    async def wait_forever(server, message, **data):
+        """Wait until cancelled."""
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            server.store["cancelled"].set()
+            raise
+        return message
+
+    server.register_command("wait_forever", wait_forever)
+    return server
+
+
+async def send(writer, **kwargs):
+    """Send a message."""
+    writer.write(Message(client="client-1", **kwargs).encode().encode())
+    await writer.drain()
+
+
+def test_cancel_on_disconnect(servers, sock_path):
+    """Test that the command is cancelled when the client disconnects."""
+    server = create_server(sock_path, cancel_on_eof=True)
+
+    async def run():
+        async with servers:
+            await servers.start(server)
+            reader, writer = await open_unix_connection(sock_path)
+            await reader.readline()
+            await send(writer, command="wait_forever", data={})
+            await asyncio.sleep(0.05)
+            writer.close()
+            await asyncio.wait_for(server.store["cancelled"].wait(), 1)
+            return server.metrics()
+
+    metrics = asyncio.run(run())
+
+    assert metrics["wasted_work_avoided"][CANCEL_REASON_DISCONNECT] == 1
+
+
+def test_reply_after_half_close(servers):
+    """Test that a client that closes its side of the connection gets a reply."""
+    server = CPIAServer(port=0)
+
+    async def slow_echo(server, message, **data):
+        """Reply with the message after a while."""
+        await asyncio.sleep(0.1)
+        return message
+
+    server.register_command("slow_echo", slow_echo)
+
+    async def run():
+        async with servers:
+            await servers.start(server)
+            port = server.server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("localhost", port)
+            await reader.readline()
+            await send(writer, command="slow_echo", data={})
+            writer.write_eof()
+            data = await asyncio.wait_for(reader.readline(), 1)
+            writer.close()
+        return Message.decode(data.decode()), server.metrics()
+
+    reply, metrics = asyncio.run(run())
+
+    assert reply.command == "slow_echo"
+    assert CANCEL_REASON_DISCONNECT not in metrics["wasted_work_avoided"]
+
+
+def test_cancel_on_reset(servers):
+    """Test that the command is cancelled when the connection is reset."""
+    server = create_server(None, port=0, tcp=True)
+
+    async def run():
+        async with servers:
+            await servers.start(server)
+            port = server.server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("localhost", port)
+            await reader.readline()
+            await send(writer, command="wait_forever", data={})
+            await asyncio.sleep(0.05)
+            # Close without lingering to send a reset instead of an eof.
+            sock = writer.get_extra_info("socket")
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+            )
+            writer.transport.abort()
+            await asyncio.wait_for(server.store["cancelled"].wait(), 1)
+            return server.metrics()
+
+    metrics = asyncio.run(run())
+
+    assert metrics["wasted_work_avoided"][CANCEL_REASON_DISCONNECT] == 1
+
+
+def test_cancel_message(servers, sock_path):
+    """Test that a cancel message cancels the request with the request id."""
+    server = create_server(sock_path)
+
+    async def run():
+        async with servers:
+            await servers.start(server)
+            reader, writer = await open_unix_connection(sock_path)
+            await reader.readline()
+            await send(writer, command="wait_forever", data={}, request_id="req-1")
+            await send(writer, command="cancel", data={"rid": "req-1"})
+            data = await asyncio.wait_for(reader.readline(), 1)
+            writer.close()
+            metrics = server.metrics()
+        return Message.decode(data.decode()), metrics
+
+    reply, metrics = asyncio.run(run())
+
+    assert reply.command == CANCELLED_COMMAND
+    assert reply.request_id == "req-1"
+    assert metrics["wasted_work_avoided"][CANCEL_REASON_MESSAGE] == 1
+
+
+def test_cancel_message_without_data(tmp_path, servers, sock_path):
+    """Test that a cancel message without data cancels its own request id."""
+    capture_path = tmp_path / "traffic.cap"
+    server = create_server(sock_path, capture=CaptureWriter(capture_path))
+
+    async def run():
+        async with servers:
+            await servers.start(server)
+            reader, writer = await open_unix_connection(sock_path)
+            await reader.readline()
+            await send(writer, command="wait_forever", data={}, request_id="req-1")
+            writer.write(b'{"cli": "client-1", "cmd": "cancel", "rid": "req-1"}\n')
+            await writer.drain()
+            data = await asyncio.wait_for(reader.readline(), 1)
+            writer.close()
+        return Message.decode(data.decode())
+
+    reply = asyncio.run(run())
+    records = list(read_capture(capture_path))
+
+    assert reply.command == CANCELLED_COMMAND
+    assert reply.request_id == "req-1"
+    commands = [Message.decode(line).command for _, _, _, line in records]
+    assert commands == ["wait_forever", "cancel"]
+
+
+def test_cancel_process_recv():
+    """Test that a cancelled receive doesn't leak its result to the next one."""
+
+    async def run():
+        server = CPIAServer()
+        recv, send_data = create_process(server, create_sleeper)
+        job_id = await send_data(0.5)
+        try:
+            await asyncio.wait_for(recv(job_id), 0.1)
+        except asyncio.TimeoutError:
+            pass
+        job_id = await send_data(0)
+        result = await asyncio.wait_for(recv(job_id), 10)
+        await server.stop()
+        return result
+
+    assert asyncio.run(run()) == 0
+
+
+def test_process_recv_without_job_id():
+    """Test that receiving without a job id gets the oldest job of the caller."""
+
+    async def run():
+        server = CPIAServer()
+        recv, send_data = create_process(server, create_sleeper)
+
+        async def call(seconds):
+            """Send jobs and receive their results without job ids."""
+            await send_data(seconds)
+            await send_data(seconds * 2)
+            return [await recv(), await recv()]
+
+        results = await asyncio.wait_for(asyncio.gather(call(0.1), call(0.2)), 10)
+        await server.stop()
+        return results
+
+    assert asyncio.run(run()) == [[0.1, 0.2], [0.2, 0.4]]
+
+
+def test_cancel_process_recv_concurrent():
+    """Test that cancelling one receive doesn't affect another caller."""
+
+    async def run():
+        server = CPIAServer()
+        recv, send_data = create_process(server, create_sleeper)
+
+        async def call(seconds, timeout):
+            """Send a job and receive its result."""
+            job_id = await send_data(seconds)
+            return await asyncio.wait_for(recv(job_id), timeout)
+
+        task_a = asyncio.ensure_future(call(0.3, 10))
+        await asyncio.sleep(0)
+        task_b = asyncio.ensure_future(call(0.2, 0.1))
+        results = await asyncio.gather(task_a, task_b, return_exceptions=True)
+        await server.stop()
+        return results
+
+    result_a, result_b = asyncio.run(run())
+
+    assert result_a == 0.3
+    assert isinstance(result_b, asyncio.TimeoutError)
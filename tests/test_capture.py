@@ -0,0 +1,115 @@
+"""Provide tests for traffic capture and replay."""
+import asyncio
+import json
+
+import pytest
+
+from cpias.capture import CaptureWriter, read_capture, replay, truncate
+from cpias.message import Message
+from cpias.server import CPIAServer
+from cpias.unix import open_unix_connection
+
+
+async def echo(server, message, **data):
+    """Reply with the message."""
+    return message
+
+
+def test_truncate():
+    """Test truncating long strings in message data."""
+    data = {"short": "abc", "long": "x" * 10, "nested": ["y" * 10, 1]}
+
+    assert truncate(data, None) == (data, False)
+    assert truncate(data, 5) == (
+        {"short": "abc", "long": "xxxxx", "nested": ["yyyyy", 1]},
+        True,
+    )
+    assert truncate({"short": "abc"}, 5) == ({"short": "abc"}, False)
+
+
+def test_record_is_written_at_once(tmp_path):
+    """Test that each record is on disk before the writer is closed."""
+    capture_path = tmp_path / "traffic.cap"
+    writer = CaptureWriter(capture_path)
+    for _ in range(3):
+        writer.record(0, Message(client="client-1", command="echo", data={}))
+
+    records = list(read_capture(capture_path))
+    writer.close()
+
+    assert len(records) == 3
+
+
+def test_negative_max_payload(tmp_path):
+    """Test that a negative max payload is rejected."""
+    with pytest.raises(ValueError):
+        CaptureWriter(tmp_path / "traffic.cap", max_payload=-1)
+
+
+def test_capture_and_replay(tmp_path, servers, sock_path):
+    """Test capturing dispatched messages and replaying them against a server."""
+    capture_path = tmp_path / "traffic.cap"
+    server = CPIAServer(
+        unix_path=sock_path,
+        tcp=False,
+        capture=CaptureWriter(capture_path, max_payload=4),
+    )
+    server.register_command("echo", echo)
+
+    async def run():
+        async with servers:
+            await servers.start(server)
+            for client in ("client-1", "client-2"):
+                reader, writer = await open_unix_connection(sock_path)
+                await reader.readline()
+                unknown = Message(client=client, command="unknown", data={})
+                writer.write(unknown.encode().encode())
+                for planet in ("Mars", "Neptune"):
+                    msg = Message(
+                        client=client, command="echo", data={"planet": planet}
+                    )
+                    writer.write(msg.encode().encode())
+                    await writer.drain()
+                    await reader.readline()
+                writer.close()
+            server.capture.close()
+            records = list(read_capture(capture_path))
+
+            stats = await replay(capture_path, f"unix:{sock_path}", speed=0)
+        return records, stats
+
+    records, stats = asyncio.run(run())
+
+    assert [conn_id for _, _, conn_id, _ in records] == [0, 0, 1, 1]
+    assert Message.decode(records[1][3]).data == {"planet": "Nept"}
+    assert len(stats.latencies) == 4
+    assert stats.errors == 0
+
+
+def test_replay_runs_without_gap(tmp_path, servers, sock_path):
+    """Test that runs appended to one capture file are replayed apart."""
+    capture_path = tmp_path / "traffic.cap"
+    for _ in range(2):
+        writer = CaptureWriter(capture_path)
+        writer.record(0, Message(client="client-1", command="echo", data={}))
+        writer.close()
+    # Move the second run an hour after the first one.
+    lines = capture_path.read_text().splitlines()
+    second = json.loads(lines[1])
+    second["t"] += 3600
+    capture_path.write_text(f"{lines[0]}\n{json.dumps(second)}\n")
+
+    server = CPIAServer(unix_path=sock_path, tcp=False)
+    server.register_command("echo", echo)
+
+    async def run():
+        async with servers:
+            await servers.start(server)
+            return await asyncio.wait_for(replay(capture_path, f"unix:{sock_path}"), 5)
+
+    records = list(read_capture(capture_path))
+    stats = asyncio.run(run())
+
+    assert len({run_id for _, run_id, _, _ in records}) == 2
+    assert len(stats.latencies) == 2
+    assert stats.errors == 0
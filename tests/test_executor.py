@@ -0,0 +1,69 @@
+"""Provide tests for named executors."""
+import asyncio
+import threading
+
+from cpias.executor import DEFAULT_EXECUTOR, NamedExecutor
+from cpias.message import Message
+from cpias.server import CPIAServer
+from cpias.unix import open_unix_connection
+
+
+async def thread_name(server, message, **data):
+    """Reply with the name of the thread that ran the job."""
+    reply = message.copy()
+    reply.data["thread"] = await server.add_executor_job(
+        lambda: threading.current_thread().name
+    )
+    return reply
+
+
+def test_command_pinned_to_executor(servers, sock_path):
+    """Test that the jobs of a command run in its executor."""
+    server = CPIAServer(unix_path=sock_path, tcp=False)
+    server.register_executor("io", max_workers=2)
+    server.register_command("pinned", thread_name, executor="io")
+    server.register_command("unpinned", thread_name)
+
+    async def run():
+        async with servers:
+            await servers.start(server)
+            reader, writer = await open_unix_connection(sock_path)
+            await reader.readline()
+            replies = []
+            for command in ("pinned", "unpinned"):
+                msg = Message(client="client-1", command=command, data={})
+                writer.write(msg.encode().encode())
+                await writer.drain()
+                data = await reader.readline()
+                replies.append(Message.decode(data.decode()))
+            writer.close()
+        return replies
+
+    pinned_reply, unpinned_reply = asyncio.run(run())
+
+    assert pinned_reply.data["thread"].startswith("cpias-io")
+    assert unpinned_reply.data["thread"].startswith(f"cpias-{DEFAULT_EXECUTOR}")
+    stats = server.metrics()["executors"]
+    assert stats["io"]["submitted"] == 1
+    assert stats[DEFAULT_EXECUTOR]["submitted"] == 1
+
+
+def test_executor_saturation():
+    """Test that executor stats show queued jobs."""
+    executor = NamedExecutor("test", max_workers=1)
+    event = threading.Event()
+
+    async def run():
+        futures = [executor.submit(event.wait) for _ in range(3)]
+        stats = executor.stats()
+        event.set()
+        await asyncio.gather(*futures)
+        executor.shutdown()
+        return stats
+
+    stats = asyncio.run(run())
+
+    assert stats["active"] == 1
+    assert stats["queued"] == 2
+    assert stats["saturation"] == 3.0
+    assert executor.stats()["saturation"] == 0.0
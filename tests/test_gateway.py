@@ -0,0 +1,183 @@
+"""Provide tests for the gateway."""
+import asyncio
+import os
+
+from cpias.gateway import ROUTING_HASH, UNAVAILABLE_COMMAND, Backend, CPIAGateway
+from cpias.message import Message
+from cpias.server import CPIAServer
+from cpias.unix import open_unix_connection
+
+
+def make_whoami(name):
+    """Return a command that replies with the backend name."""
+
+    async def whoami(server, message, **data):
+        """Reply with the backend name."""
+        reply = message.copy()
+        reply.data["backend"] = name
+        return reply
+
+    return whoami
+
+
+async def send_messages(path, messages):
+    """Send messages over one connection and return the replies."""
+    reader, writer = await open_unix_connection(path)
+    await reader.readline()
+    replies = []
+    for msg in messages:
+        writer.write(msg.encode().encode())
+        await writer.drain()
+        data = await reader.readline()
+        replies.append(Message.decode(data.decode()))
+    writer.close()
+    return replies
+
+
+async def start_cluster(servers, tmp_path, names, **kwargs):
+    """Start backends and a gateway, and return the backends and gateway path."""
+    backends = {}
+    for name in names:
+        backend = CPIAServer(unix_path=str(tmp_path / f"{name}.sock"), tcp=False)
+        backend.register_command("whoami", make_whoami(name))
+        backends[name] = await servers.start(backend)
+    gateway_path = str(tmp_path / "gateway.sock")
+    gateway = CPIAGateway(
+        [f"unix:{backend.unix_path}" for backend in backends.values()],
+        unix_path=gateway_path,
+        tcp=False,
+        **kwargs,
+    )
+    await servers.start(gateway)
+    return backends, gateway_path
+
+
+def test_hash_routing_is_sticky(tmp_path, servers):
+    """Test that the same key is always routed to the same backend."""
+
+    async def run():
+        async with servers:
+            _, path = await start_cluster(
+                servers,
+                tmp_path,
+                ["one", "two", "three"],
+                routing=ROUTING_HASH,
+                hash_key="dataset",
+            )
+            messages = [
+                Message(client=f"client-{idx}", command="whoami", data={"dataset": key})
+                for idx in range(4)
+                for key in ("plate-1", "plate-2", "plate-3")
+            ]
+            return await send_messages(path, messages)
+
+    replies = asyncio.run(run())
+
+    by_dataset = {}
+    for reply in replies:
+        by_dataset.setdefault(reply.data["dataset"], set()).add(reply.data["backend"])
+    assert all(len(names) == 1 for names in by_dataset.values())
+
+
+def test_least_outstanding_failover(tmp_path, servers):
+    """Test that requests are retried on a healthy backend."""
+
+    async def run():
+        async with servers:
+            backends, path = await start_cluster(servers, tmp_path, ["one", "two"])
+            await servers.stop(backends["one"])
+            msg = Message(client="client-1", command="whoami", data={})
+            replies = await send_messages(path, [msg, msg])
+            await servers.stop(backends["two"])
+            replies.extend(await send_messages(path, [msg]))
+        return replies
+
+    replies = asyncio.run(run())
+
+    assert [reply.data.get("backend") for reply in replies[:2]] == ["two", "two"]
+    assert replies[2].command == UNAVAILABLE_COMMAND
+
+
+def test_unknown_command_frees_connection(tmp_path, servers):
+    """Test that a request without reply times out and frees its connection."""
+
+    async def run():
+        async with servers:
+            _, path = await start_cluster(
+                servers, tmp_path, ["one"], request_timeout=0.2, max_connections=1
+            )
+            unknown = Message(client="client-1", command="nope", data={})
+            whoami = Message(client="client-1", command="whoami", data={})
+            return await asyncio.wait_for(
+                send_messages(path, [unknown, unknown, whoami]), 5
+            )
+
+    replies = asyncio.run(run())
+
+    assert [reply.command for reply in replies[:2]] == [UNAVAILABLE_COMMAND] * 2
+    assert replies[2].data["backend"] == "one"
+
+
+def test_stale_connections_dropped(tmp_path):
+    """Test that a failed pooled connection drops the idle ones and retries."""
+    path = str(tmp_path / "backend.sock")
+    writers = []
+
+    async def echo_lines(reader, writer):
+        """Send a welcome line and echo each line."""
+        writers.append(writer)
+        writer.write(b"welcome\n")
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            writer.write(line)
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_unix_server(echo_lines, path)
+        backend = Backend(f"unix:{path}")
+        await asyncio.gather(*(backend.request(b"ping\n", 1) for _ in range(3)))
+        idle_before = len(backend._idle)  # pylint: disable=protected-access
+        # Close the connections on the backend side, like a backend restart.
+        for writer in writers:
+            writer.close()
+        await asyncio.sleep(0.05)
+        reply = await backend.request(b"ping\n", 1)
+        idle_after = len(backend._idle)  # pylint: disable=protected-access
+        backend.close()
+        server.close()
+        await server.wait_closed()
+        return idle_before, reply, idle_after
+
+    idle_before, reply, idle_after = asyncio.run(run())
+
+    assert idle_before == 3
+    assert reply == b"ping\n"
+    assert idle_after == 1
+    assert len(writers) == 4
+
+
+def test_fds_not_forwarded(tmp_path, servers, caplog):
+    """Test that the gateway warns about file descriptors it can't forward."""
+    file_path = tmp_path / "data.bin"
+    file_path.write_bytes(b"z" * 7)
+
+    async def run():
+        async with servers:
+            _, path = await start_cluster(servers, tmp_path, ["one"])
+            reader, writer = await open_unix_connection(path)
+            await reader.readline()
+            msg = Message(client="client-1", command="whoami", data={})
+            fd = os.open(file_path, os.O_RDONLY)
+            writer.write(msg.encode().encode(), [fd])
+            await writer.drain()
+            os.close(fd)
+            data = await reader.readline()
+            writer.close()
+        return Message.decode(data.decode())
+
+    reply = asyncio.run(run())
+
+    assert reply.data["backend"] == "one"
+    assert "Can't forward file descriptors" in caplog.text
@@ -32,3 +32,16 @@ def test_message_encode():
     msg_encoded = msg.encode()
 
     assert msg_encoded == msg_string
+
+
+def test_message_request_id():
+    """Test message request id encode and decode."""
+    msg_string = (
+        '{"cli": "client-1", "cmd": "hello", "dta": {"param1": "world"}, '
+        '"rid": "req-1"}\n'
+    )
+    msg = Message.decode(msg_string)
+
+    assert msg.request_id == "req-1"
+    assert msg.encode() == msg_string
+    assert msg.copy().request_id == "req-1"
@@ -0,0 +1,100 @@
+"""Provide tests for the unix socket transport."""
+import asyncio
+import os
+import socket
+
+import pytest
+
+from cpias.message import Message
+from cpias.server import CPIAServer
+from cpias.unix import UnixReader, UnixWriter, open_unix_connection
+
+
+async def echo_sizes(server, message, **data):
+    """Reply with the sizes of the passed files in the received message."""
+    message.data["sizes"] = [os.fstat(fd).st_size for fd in message.fds]
+    return message
+
+
+def test_reader_attributes_fds_to_lines(tmp_path):
+    """Test that file descriptors are attached to the line they were sent with."""
+    file_path = tmp_path / "data.bin"
+    file_path.write_bytes(b"x" * 10)
+
+    async def run():
+        left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        left.setblocking(False)
+        right.setblocking(False)
+        writer = UnixWriter(left)
+        reader = UnixReader(right)
+        fd = os.open(file_path, os.O_RDONLY)
+        writer.write(b"first\n")
+        writer.write(b"second\n", [fd])
+        writer.write(b"third\n")
+        await writer.drain()
+        os.close(fd)
+
+        lines = []
+        for _ in range(3):
+            line = await reader.readline()
+            lines.append((line, [os.fstat(fd).st_size for fd in reader.last_fds]))
+            for received_fd in reader.last_fds:
+                os.close(received_fd)
+        writer.close()
+        right.close()
+        return lines
+
+    lines = asyncio.run(run())
+
+    assert lines == [(b"first\n", []), (b"second\n", [10]), (b"third\n", [])]
+
+
+def test_reader_line_limit():
+    """Test that a line longer than the limit raises instead of buffering."""
+
+    async def run():
+        left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        left.setblocking(False)
+        right.setblocking(False)
+        writer = UnixWriter(left)
+        reader = UnixReader(right, limit=10)
+        writer.write(b"x" * 100)
+        await writer.drain()
+        try:
+            with pytest.raises(ValueError):
+                await reader.readline()
+        finally:
+            writer.close()
+            right.close()
+
+    asyncio.run(run())
+
+
+def test_server_unix_socket_fd_passing(tmp_path, servers, sock_path):
+    """Test sending a message with a file descriptor to a unix socket server."""
+    file_path = tmp_path / "data.bin"
+    file_path.write_bytes(b"y" * 42)
+    server = CPIAServer(unix_path=sock_path, tcp=False)
+    server.register_command("echo_sizes", echo_sizes)
+
+    async def run():
+        async with servers:
+            await servers.start(server)
+            reader, writer = await open_unix_connection(sock_path)
+            version_msg = await reader.readline()
+            msg = Message(client="client-1", command="echo_sizes", data={})
+            fd = os.open(file_path, os.O_RDONLY)
+            writer.write(msg.encode().encode(), [fd])
+            await writer.drain()
+            os.close(fd)
+            data = await reader.readline()
+            reply_fds = reader.last_fds
+            writer.close()
+        return version_msg, Message.decode(data.decode()), reply_fds
+
+    version_msg, reply, reply_fds = asyncio.run(run())
+
+    assert version_msg.startswith(b"CPIAServer version")
+    assert reply.data == {"sizes": [42]}
+    assert reply_fds == []
+    assert not os.path.exists(sock_path)